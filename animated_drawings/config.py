@@ -80,6 +80,87 @@ class SceneConfig():
             logging.critical(msg)
             assert False, msg
 
+        # directory in which to cache expensive per-character precomputation. If None, nothing is cached
+        try:
+            self.cache_dir: Union[None, str] = scene_cfg['CACHE_DIR']
+            assert isinstance(self.cache_dir, (NoneType, str)), 'type is not None or str'
+        except (AssertionError, ValueError) as e:
+            msg = f'Error in CACHE_DIR config parameter: {e}'
+            logging.critical(msg)
+            assert False, msg
+
+        # size above which least recently used files are evicted from the cache directory
+        try:
+            self.cache_max_mb: Union[float, int] = scene_cfg['CACHE_MAX_MB']
+            assert isinstance(self.cache_max_mb, (float, int)), 'is not float or int'
+            assert self.cache_max_mb > 0, 'size must be > 0'
+        except (AssertionError, ValueError) as e:
+            msg = f'Error in CACHE_MAX_MB config parameter: {e}'
+            logging.critical(msg)
+            assert False, msg
+
+        # deform all characters with one combined arap solve, rather than one solve per character
+        try:
+            self.combine_arap_solves: bool = scene_cfg['COMBINE_ARAP_SOLVES']
+            assert isinstance(self.combine_arap_solves, bool), 'is not bool'
+        except (AssertionError, ValueError) as e:
+            msg = f'Error in COMBINE_ARAP_SOLVES config parameter: {e}'
+            logging.critical(msg)
+            assert False, msg
+
+        # if set, arap deforms a coarse control mesh with this grid density, and the render mesh follows it
+        try:
+            self.arap_control_mesh_density: Union[None, int] = scene_cfg['ARAP_CONTROL_MESH_DENSITY']
+            assert isinstance(self.arap_control_mesh_density, (NoneType, int)), 'type is not None or int'
+            if isinstance(self.arap_control_mesh_density, int):
+                assert self.arap_control_mesh_density >= 2, 'density must be >= 2'
+        except (AssertionError, ValueError) as e:
+            msg = f'Error in ARAP_CONTROL_MESH_DENSITY config parameter: {e}'
+            logging.critical(msg)
+            assert False, msg
+
+        # if set, character meshes are simplified as needed to have at most this many vertices
+        try:
+            self.mesh_max_vertices: Union[None, int] = scene_cfg['MESH_MAX_VERTICES']
+            assert isinstance(self.mesh_max_vertices, (NoneType, int)), 'type is not None or int'
+            if isinstance(self.mesh_max_vertices, int):
+                assert self.mesh_max_vertices > 0, 'vertex count must be > 0'
+        except (AssertionError, ValueError) as e:
+            msg = f'Error in MESH_MAX_VERTICES config parameter: {e}'
+            logging.critical(msg)
+            assert False, msg
+
+        # if set, masks larger than this are downscaled to it before meshing and joint assignment
+        try:
+            self.mask_working_resolution: Union[None, int] = scene_cfg['MASK_WORKING_RESOLUTION']
+            assert isinstance(self.mask_working_resolution, (NoneType, int)), 'type is not None or int'
+            if isinstance(self.mask_working_resolution, int):
+                assert self.mask_working_resolution > 0, 'resolution must be > 0'
+        except (AssertionError, ValueError) as e:
+            msg = f'Error in MASK_WORKING_RESOLUTION config parameter: {e}'
+            logging.critical(msg)
+            assert False, msg
+
+        # number of arap results, keyed by pose, to keep in each character's LRU cache. 0 disables the cache
+        try:
+            self.arap_result_cache_size: int = scene_cfg['ARAP_RESULT_CACHE_SIZE']
+            assert isinstance(self.arap_result_cache_size, int), 'is not int'
+            assert self.arap_result_cache_size >= 0, 'size must be >= 0'
+        except (AssertionError, ValueError) as e:
+            msg = f'Error in ARAP_RESULT_CACHE_SIZE config parameter: {e}'
+            logging.critical(msg)
+            assert False, msg
+
+        # poses whose joint positions round to the same multiples of this value share a cached arap result
+        try:
+            self.arap_result_cache_quantization: float = scene_cfg['ARAP_RESULT_CACHE_QUANTIZATION']
+            assert isinstance(self.arap_result_cache_quantization, (float, int)), 'is not float or int'
+            assert self.arap_result_cache_quantization > 0, 'quantization must be > 0'
+        except (AssertionError, ValueError) as e:
+            msg = f'Error in ARAP_RESULT_CACHE_QUANTIZATION config parameter: {e}'
+            logging.critical(msg)
+            assert False, msg
+
         # config files for characters, driving motions, and retargeting
         self.animated_characters: List[Tuple[CharacterConfig, RetargetConfig, MotionConfig]] = []
 
@@ -75,6 +75,13 @@ class VideoRenderController(Controller):
         self.delta_t = frame_time[0]
 
     def _prep_for_run_loop(self) -> None:
+        # every frame will be rendered, so pose each character for all frames up front. Meshes are then deformed in batches
+        _time = time.time()
+        for child in self.scene.get_children():
+            if isinstance(child, AnimatedDrawing):
+                child.precompute_vertex_track()
+        logging.info(f'Precomputed character poses in {time.time()-_time} seconds.')
+
         self.run_loop_start_time = time.time()
 
     def _is_run_over(self) -> bool:
@@ -4,29 +4,31 @@
 
 import logging
 import ctypes
-import heapq
+import hashlib
 import math
-import time
-from typing import Dict, List, Tuple, Optional, TypedDict, DefaultDict
-from collections import defaultdict
+from typing import Dict, List, Mapping, Tuple, Optional, TypedDict, Union
 from pathlib import Path
 
 import cv2
 import numpy as np
 import numpy.typing as npt
 from skimage import measure
-from shapely import geometry
+from skimage.graph import MCP_Geometric
+from shapely import geometry, vectorized
 from OpenGL import GL
 
 from scipy.spatial import Delaunay
+from scipy.sparse import csr_matrix, csgraph
+from scipy import ndimage
 from animated_drawings.model.transform import Transform
 from animated_drawings.model.time_manager import TimeManager
 from animated_drawings.model.retargeter import Retargeter
-from animated_drawings.model.arap import ARAP
+from animated_drawings.model.arap import ARAP, get_barycentric_interpolation_matrix
 from animated_drawings.model.joint import Joint
 from animated_drawings.model.quaternions import Quaternions
 from animated_drawings.model.vectors import Vectors
 from animated_drawings.config import CharacterConfig, MotionConfig, RetargetConfig
+from animated_drawings.utils import read_cache_file, write_cache_file
 
 
 class AnimatedDrawingMesh(TypedDict):
@@ -41,7 +43,6 @@ class AnimatedDrawingsJoint(Joint):
         super().__init__(name=name, offset=np.array([x, 1 - y, 0]))
 
         self.starting_theta: float
-        self.current_theta: float
 
 
 class AnimatedDrawingRig(Transform):
@@ -97,6 +98,25 @@ class AnimatedDrawingRig(Transform):
         # cache for later
         self.joint_count = joints_d['root'].joint_count()
 
+        # Per-frame forward kinematics runs on arrays rather than on the joint Transforms: joints are indexed in the
+        # depth-first order of root_joint.get_chain_joint_names(), and rotations are angles about the z axis.
+        # The joint Transforms are only brought up to date when the rig is drawn (see _update_joint_transforms())
+        joint_names: List[str] = self.root_joint.get_chain_joint_names()
+        self._joints: List[AnimatedDrawingsJoint] = [joints_d[name] for name in joint_names]
+        self._joint_idx: Dict[str, int] = {name: idx for idx, name in enumerate(joint_names)}
+        self._parent_idx: npt.NDArray[np.int64] = np.array([-1 if j.get_parent() is self else self._joint_idx[j.get_parent().name] for j in self._joints])
+        self._offsets: npt.NDArray[np.float64] = np.array([j.get_local_position() for j in self._joints], dtype=np.float64)  # from parent
+        self._starting_theta: npt.NDArray[np.float64] = np.array([j.starting_theta for j in self._joints])
+        self._current_theta: npt.NDArray[np.float64] = np.full(self.joint_count, np.nan)  # radians. nan until first oriented
+        self._local_theta: npt.NDArray[np.float64] = np.zeros(self.joint_count)            # rotation of each joint's frame
+
+        # _ancestors[j, k] is 1 if joint k is joint j or one of its ancestors
+        self._ancestors: npt.NDArray[np.float64] = np.identity(self.joint_count)
+        for idx in range(1, self.joint_count):  # parents precede children in depth-first order
+            self._ancestors[idx] += self._ancestors[self._parent_idx[idx]]
+
+        self._joint_transforms_dirty_bit: bool = False
+
         # set up buffer for visualizing vertices
         self.vertices = np.zeros([2 * (self.joint_count - 1), 6], np.float32)
 
@@ -104,14 +124,97 @@ class AnimatedDrawingRig(Transform):
         self._vertex_buffer_dirty_bit: bool = True
 
     def set_global_orientations(self, bvh_frame_orientations: Dict[str, float]) -> None:
-        """ Applies orientation from bvh_frame_orientation to the rig. """
+        """
+        Applies orientation from bvh_frame_orientation to the rig.
+        Each oriented joint's angle (relative to its parent's, if the parent is oriented) becomes the rotation of its
+        parent's frame. If several children of a joint are oriented, the last one, in depth-first order, determines it.
+        """
+        if not self._apply_orientations(bvh_frame_orientations, self._current_theta, self._local_theta):
+            return
 
-        self._set_global_orientations(self.root_joint, bvh_frame_orientations)
+        self._joint_transforms_dirty_bit = True
         self._vertex_buffer_dirty_bit = True
 
     def get_joints_2D_positions(self) -> npt.NDArray[np.float32]:
         """ Returns array of 2D joints positions for rig.  """
-        return np.array(self.root_joint.get_chain_worldspace_positions()).reshape([-1, 3])[:, :2]
+        return self._get_joints_positions()[:, :2].astype(np.float32)
+
+    def get_clip_joints_2D_positions(self, clip_orientations: Dict[str, npt.NDArray[np.float32]]) -> npt.NDArray[np.float32]:
+        """
+        Input: clip_orientations, mapping joint names to ndarrays [F] of orientations, one per frame (as in Retargeter.char_joint_to_orientation).
+        Returns ndarray [F, J, 2] of joint positions, relative to the root joint, with the rig posed by each frame's orientations
+        in turn, as if set_global_orientations() had been called once per frame. Does not change the rig's pose.
+        """
+        frame_num: int = len(next(iter(clip_orientations.values()))) if clip_orientations else 0
+        current_theta = np.tile(self._current_theta, (frame_num, 1))
+        local_theta = np.tile(self._local_theta, (frame_num, 1))
+        self._apply_orientations(clip_orientations, current_theta, local_theta)
+
+        return self._get_root_relative_joints_positions(local_theta)[..., :2].astype(np.float32)
+
+    def _apply_orientations(self, orientations: Mapping[str, Union[float, npt.NDArray[np.float32]]],
+                            current_theta: npt.NDArray[np.float64], local_theta: npt.NDArray[np.float64]) -> bool:
+        """
+        Updates current_theta and local_theta, ndarrays [..., J], in place from orientations, which maps joint names to
+        orientations broadcastable to [...]. Returns False if none of the oriented joints are in the rig.
+        """
+        idxs = np.array(sorted(self._joint_idx[name] for name in orientations.keys() if name in self._joint_idx), dtype=np.int64)
+        if len(idxs) == 0:
+            return False
+        thetas = np.stack([np.asarray(orientations[self._joints[idx].name], dtype=np.float64) for idx in idxs], axis=-1)
+
+        # an oriented joint rotates its parent's frame, so the root, whose parent is the rig, cannot be oriented
+        parent_idxs = self._parent_idx[idxs]
+        if np.any(parent_idxs < 0):
+            msg = f'Cannot orient root joint {self.root_joint.name}: it has no parent joint to rotate'
+            logging.critical(msg)
+            assert False, msg
+
+        current_theta[..., idxs] = np.radians(thetas - self._starting_theta[idxs])
+        parent_theta = current_theta[..., parent_idxs]
+        child_theta = current_theta[..., idxs] - np.where(np.isnan(parent_theta), 0.0, parent_theta)
+
+        # keep the last child of each parent
+        last = len(idxs) - 1 - np.unique(parent_idxs[::-1], return_index=True)[1]
+        local_theta[..., parent_idxs[last]] = child_theta[..., last]
+
+        return True
+
+    def _get_joints_positions(self) -> npt.NDArray[np.float64]:
+        """
+        Forward kinematics. Returns ndarray [J, 3] of joint positions, in depth-first order.
+        Positions are relative to the rig's parent. Neither the rig nor its ancestors are ever moved, so this is world space.
+        """
+        return self._get_root_relative_joints_positions(self._local_theta) + self.root_joint.get_local_position()
+
+    def _get_root_relative_joints_positions(self, local_theta: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+        """
+        Forward kinematics for local_theta, ndarray [..., J] of joint frame rotations.
+        Returns ndarray [..., J, 3] of joint positions relative to the root joint, in depth-first order.
+        """
+        world_theta = local_theta @ self._ancestors.T
+
+        # offset of each joint from its parent, rotated by its parent's frame. The root's is zero
+        parent_theta = world_theta[..., self._parent_idx[1:]]
+        cos, sin = np.cos(parent_theta), np.sin(parent_theta)
+        rotated_offsets = np.zeros(local_theta.shape + (3,), dtype=np.float64)
+        rotated_offsets[..., 1:, 0] = cos * self._offsets[1:, 0] - sin * self._offsets[1:, 1]
+        rotated_offsets[..., 1:, 1] = sin * self._offsets[1:, 0] + cos * self._offsets[1:, 1]
+        rotated_offsets[..., 1:, 2] = self._offsets[1:, 2]
+
+        return self._ancestors @ rotated_offsets
+
+    def _update_joint_transforms(self) -> None:
+        """ Applies the rotations from the latest set_global_orientations() to the joint Transforms. """
+        if not self._joint_transforms_dirty_bit:
+            return
+
+        for joint, theta in zip(self._joints, self._local_theta):
+            if joint.get_children():
+                joint.set_rotation(Quaternions.from_angle_axis(np.array([theta]), axes=Vectors([0.0, 0.0, 1.0])))
+        self.root_joint.update_transforms()
+
+        self._joint_transforms_dirty_bit = False
 
     def _compute_buffer_vertices(self, parent: Optional[Transform], pointer: List[int]) -> None:
         """ Recomputes values to pass to vertex buffer. Called recursively, pointer is List[int] to emulate pass-by-reference """
@@ -157,6 +260,7 @@ class AnimatedDrawingRig(Transform):
 
     def _compute_and_buffer_vertex_data(self):
 
+        self._update_joint_transforms()
         self._compute_buffer_vertices(parent=self.root_joint, pointer=[0])
 
         GL.glBindVertexArray(self.vao)
@@ -167,26 +271,6 @@ class AnimatedDrawingRig(Transform):
 
         self._vertex_buffer_dirty_bit = False
 
-    def _set_global_orientations(self, joint: AnimatedDrawingsJoint, bvh_orientations: Dict[str, float]) -> None:
-        if joint.name in bvh_orientations.keys():
-
-            theta: float = bvh_orientations[str(joint.name)] - joint.starting_theta
-            theta = np.radians(theta)
-            joint.current_theta = theta
-
-            parent = joint.get_parent()
-            assert isinstance(parent, AnimatedDrawingsJoint)
-            if hasattr(parent, 'current_theta'):
-                theta = theta - parent.current_theta
-
-            rotation_q = Quaternions.from_angle_axis(np.array([theta]), axes=Vectors([0.0, 0.0, 1.0]))
-            parent.set_rotation(rotation_q)
-            parent.update_transforms()
-
-        for c in joint.get_children():
-            if isinstance(c, AnimatedDrawingsJoint):
-                self._set_global_orientations(c, bvh_orientations)
-
     def _draw(self, **kwargs):
         if not kwargs['viewer_cfg'].draw_ad_rig:
             return
@@ -221,9 +305,35 @@ class AnimatedDrawing(Transform, TimeManager):
     Afterwars, only the update() method needs to be called.
     """
 
-    def __init__(self, char_cfg: CharacterConfig, retarget_cfg: RetargetConfig, motion_cfg: MotionConfig):
+    MESH_CACHE_VERSION = 2  # increment when mesh generation changes, to invalidate previously cached meshes
+
+    def __init__(self,
+                 char_cfg: CharacterConfig,
+                 retarget_cfg: RetargetConfig,
+                 motion_cfg: MotionConfig,
+                 cache_dir: Optional[str] = None,
+                 cache_max_mb: float = 1024,
+                 arap_control_mesh_density: Optional[int] = None,
+                 mesh_max_vertices: Optional[int] = None,
+                 mask_working_resolution: Optional[int] = None
+                 ):
+        """
+        cache_dir: if specified, expensive precomputation (meshes, ARAP matrices, parsed BVH) is loaded from, or saved to, this directory.
+        cache_max_mb: maximum size of cache_dir. Least recently used files are evicted when exceeded.
+        arap_control_mesh_density: if specified, ARAP deforms a coarser mesh with this many interior grid points per side,
+            and the render mesh follows it via barycentric interpolation. Otherwise, ARAP deforms the render mesh directly.
+        mesh_max_vertices: if specified, the render mesh is simplified as needed to have at most this many vertices.
+        mask_working_resolution: if specified, and smaller than the padded mask, the mask is downscaled to this size before
+            the mesh is generated and triangles are assigned to joints. The texture is always used at full resolution.
+        """
         super().__init__()
 
+        self.arap_control_mesh_density: Optional[int] = arap_control_mesh_density
+        self.mesh_max_vertices: Optional[int] = mesh_max_vertices
+
+        self.cache_dir: Optional[str] = cache_dir
+        self.cache_max_mb: float = cache_max_mb
+
         self.char_cfg: CharacterConfig = char_cfg
 
         self.retarget_cfg: RetargetConfig = retarget_cfg
@@ -233,16 +343,25 @@ class AnimatedDrawing(Transform, TimeManager):
         # load mask and pad to square
         self.mask: npt.NDArray[np.uint8] = self._load_mask()
 
-        # load texture and pad to square
+        # load texture, cropped to the mask
         self.txtr: npt.NDArray[np.uint8] = self._load_txtr()
 
-        # generate the mesh
-        self.mesh: AnimatedDrawingMesh
-        self._generate_mesh()
+        # the mask-derived steps below (meshing, assigning triangles to joints) run at a working resolution, which may be
+        # lower than that of the texture. Mesh vertices are normalized to 0-1, so they are independent of either resolution
+        self.mask_dim: int = self.img_dim
+        if mask_working_resolution is not None and mask_working_resolution < self.img_dim:
+            self.mask_dim = mask_working_resolution
+            self.mask = cv2.resize(self.mask, (self.mask_dim, self.mask_dim), interpolation=cv2.INTER_AREA)
 
         self.rig = AnimatedDrawingRig(self.char_cfg)
         self.add_child(self.rig)
 
+        # generate the mesh
+        self.mesh: AnimatedDrawingMesh
+        self.arap_mesh: AnimatedDrawingMesh                  # mesh deformed by ARAP. Either self.mesh, or a coarser control mesh
+        self.arap_to_mesh: Optional[csr_matrix] = None      # maps arap_mesh vertex positions to self.mesh vertex positions
+        self._generate_mesh()
+
         # perform runtime checks for character pose, modify retarget config accordingly
         self._modify_retargeting_cfg_for_character()
 
@@ -255,11 +374,25 @@ class AnimatedDrawing(Transform, TimeManager):
         self._initialize_retargeter_bvh(motion_cfg, retarget_cfg)
 
         # initialize arap solver with original joint positions
-        self.arap = ARAP(self.rig.get_joints_2D_positions(), self.mesh['triangles'], self.mesh['vertices'])
+        self.arap = ARAP(self.rig.get_joints_2D_positions(), self.arap_mesh['triangles'], self.arap_mesh['vertices'],
+                         cache_dir=cache_dir, cache_max_mb=cache_max_mb)
 
         self.vertices: npt.NDArray[np.float32]
         self._initialize_vertices()
 
+        # root-relative arap mesh vertex xy positions for a window of consecutive bvh frames, starting at vertex_track_start_idx.
+        # Only populated once precompute_vertex_track() is called, and then solved one window at a time as update() advances
+        self.vertex_track: Optional[npt.NDArray[np.float32]] = None
+        self.vertex_track_start_idx: int = 0
+        self._vertex_track_frame_num: int = 0  # frames of vertex_track currently holding solutions
+        self._clip_control_points: Optional[npt.NDArray[np.float32]] = None  # [F, J, 2] root-relative joint positions
+
+        # if True, update() only poses the rig, and the ARAP solve is left to the scene (see Scene._solve_deferred_arap())
+        self.defer_arap_solve: bool = False
+        self.arap_solve_pending: bool = False
+        self.control_points: npt.NDArray[np.float32]    # root-relative rig joint positions from the latest update()
+        self._root_xy: npt.NDArray[np.float32]           # root xy position from the latest update()
+
         self._is_opengl_initialized: bool = False
         self._vertex_buffer_dirty_bit: bool = True
 
@@ -314,7 +447,7 @@ class AnimatedDrawing(Transform, TimeManager):
         """ Initializes the retargeter used to drive the animated character.  """
 
         # initialize retargeter
-        self.retargeter = Retargeter(motion_cfg, retarget_cfg)
+        self.retargeter = Retargeter(motion_cfg, retarget_cfg, cache_dir=self.cache_dir, cache_max_mb=self.cache_max_mb)
 
         # validate the motion and retarget config files, now that we know char/bvh joint names
         char_joint_names: List[str] = self.rig.root_joint.get_chain_joint_names()
@@ -380,18 +513,60 @@ class AnimatedDrawing(Transform, TimeManager):
         self.rig.root_joint.set_position(root_position)
         self.rig.set_global_orientations(frame_orientations)
 
-        # using new joint positions, calculate new mesh vertex xy positions
-        control_points: npt.NDArray[np.float32] = self.rig.get_joints_2D_positions() - root_position[:2]
-        self.vertices[:, :2] = self.arap.solve(control_points) + root_position[:2]
+        # using new joint positions, calculate new mesh vertex xy positions (or look them up, if precomputed)
+        if self.vertex_track is not None:
+            self.vertices[:, :2] = self._arap_to_mesh_vertices(self._get_vertex_track_frame(self.retargeter.get_frame_idx(self.get_time()))) + root_position[:2]
+        else:
+            self.control_points = self.rig.get_joints_2D_positions() - root_position[:2]
+            self._root_xy = root_position[:2]
+            if self.defer_arap_solve:
+                self.arap_solve_pending = True
+            else:
+                self.set_deformed_vertices(self.arap.solve(self.control_points))
 
-        # use the z position of the rig's root joint for all mesh vertices
-        self.vertices[:, 2] = self.rig.root_joint.get_world_position()[2]
+        # use the z position of the rig's root joint for all mesh vertices. The rig is never moved, so it is root_position's
+        self.vertices[:, 2] = root_position[2]
 
         self._vertex_buffer_dirty_bit = True
 
         # using joint depths, determine the correct order in which to render the character
         self._set_draw_indices(joint_depths)
 
+    def set_deformed_vertices(self, vertices_xy: npt.NDArray[np.float64]) -> None:
+        """ Sets mesh vertex xy positions using vertices_xy [V, 2], the ARAP solution for self.control_points. """
+        self.vertices[:, :2] = self._arap_to_mesh_vertices(vertices_xy) + self._root_xy
+        self.arap_solve_pending = False
+        self._vertex_buffer_dirty_bit = True
+
+    def precompute_vertex_track(self, frames_per_pass: int = 256) -> None:
+        """
+        Computes the rig's joint positions for every frame of the retargeted motion at once. Afterwards, update() deforms the mesh
+        with batched ARAP solves of frames_per_pass consecutive frames, starting at the current frame, and looks up the
+        mesh vertex positions of the following frames rather than solving for them. Memory use is bounded by frames_per_pass.
+        Useful when every frame will be rendered anyway, e.g. when rendering to video.
+        """
+        self._clip_control_points = self.rig.get_clip_joints_2D_positions(self.retargeter.char_joint_to_orientation)
+
+        self.vertex_track = np.empty([min(frames_per_pass, len(self._clip_control_points)), self.arap.vert_num, 2], dtype=np.float32)
+        self.vertex_track_start_idx = 0
+        self._vertex_track_frame_num = 0
+
+        # pose the character for the current time, solving the first window
+        self.update()
+
+    def _get_vertex_track_frame(self, frame_idx: int) -> npt.NDArray[np.float32]:
+        """ Returns the root-relative arap mesh vertex xy positions [V, 2] for frame_idx, solving the window starting at it if needed. """
+        assert self.vertex_track is not None and self._clip_control_points is not None
+
+        if not self.vertex_track_start_idx <= frame_idx < self.vertex_track_start_idx + self._vertex_track_frame_num:
+            frame_num = min(len(self.vertex_track), len(self._clip_control_points) - frame_idx)
+            self.arap.solve_batch(self._clip_control_points[frame_idx:frame_idx + frame_num], frames_per_pass=frame_num,
+                                  out=self.vertex_track[:frame_num])
+            self.vertex_track_start_idx = frame_idx
+            self._vertex_track_frame_num = frame_num
+
+        return self.vertex_track[frame_idx - self.vertex_track_start_idx]
+
     def _set_draw_indices(self, joint_depths: Dict[str, float]):
 
         # sort segmentation groups by decreasing depth_driver's distance to camera
@@ -409,13 +584,11 @@ class AnimatedDrawing(Transform, TimeManager):
                 indices.append(self.joint_to_tri_v_idx.get(joint_name, np.array([], dtype=np.int32)))
         self.indices = np.hstack(indices)
 
-    def _initialize_joint_to_triangles_dict(self) -> None:  # noqa: C901
+    def _initialize_joint_to_triangles_dict(self) -> None:
         """
-        Uses BFS to find and return the closest joint bone (line segment between joint and parent) to each triangle centroid.
+        Finds the closest joint bone (line segment between joint and parent) to each triangle centroid,
+        measuring distance along paths within the character mask.
         """
-        shortest_distance = np.full(self.mask.shape, 1 << 12, dtype=np.int32)  # to nearest joint
-        closest_joint_idx = np.full(self.mask.shape, -1, dtype=np.int8)  # track joint idx nearest each point
-
         # temp dictionary to help with seed generation
         joints_d: Dict[str, CharacterConfig.JointDict] = {}
         for joint in self.char_cfg.skeleton:
@@ -426,58 +599,65 @@ class AnimatedDrawing(Transform, TimeManager):
         joint_name_to_idx: List[str] = [joint['name'] for joint in self.char_cfg.skeleton]
 
         # seed generation
-        heap: List[Tuple[float, Tuple[int, Tuple[int, int]]]] = []  # [(dist, (joint_idx, (x, y))]
+        seeds_joint_idx: List[int] = []
+        seeds: List[npt.NDArray[np.int64]] = []
         for _, joint in joints_d.items():
             if joint['parent'] is None:  # skip root joint
                 continue
-            joint_idx = joint_name_to_idx.index(joint['name'])
             dist_joint_xy: List[float] = joint['loc']
             prox_joint_xy: List[float] = joints_d[joint['parent']]['loc']
-            seeds_xy = (self.img_dim * np.linspace(dist_joint_xy, prox_joint_xy, num=20, endpoint=False)).round()
-            heap.extend([(0, (joint_idx, tuple(seed_xy.astype(np.int32)))) for seed_xy in seeds_xy])
-
-        # BFS search
-        start_time: float = time.time()
-        logging.info('Starting joint -> mask pixel BFS')
-        while heap:
-            distance, (joint_idx, (x, y)) = heapq.heappop(heap)
-            neighbors = [(x-1, y-1), (x, y-1), (x+1, y-1), (x-1, y), (x+1, y), (x-1, y+1), (x, y+1), (x+1, y+1)]
-            n_dist = [1.414, 1.0, 1.414, 1.0, 1.0, 1.414, 1.0, 1.414]
-            for (n_x, n_y), n_dist in zip(neighbors, n_dist):
-                n_distance = distance + n_dist
-                if not 0 <= n_x < self.img_dim or not 0 <= n_y < self.img_dim:
-                    continue  # neighbor is outside image bounds- ignore
-
-                if not self.mask[n_x, n_y]:
-                    continue  # outside character mask
-
-                if shortest_distance[n_x, n_y] <= n_distance:
-                    continue  # a closer joint exists
-
-                closest_joint_idx[n_x, n_y] = joint_idx
-                shortest_distance[n_x, n_y] = n_distance
-                heapq.heappush(heap, (n_distance, (joint_idx, (n_x, n_y))))
-        logging.info(f'Finished joint -> mask pixel BFS in {time.time() - start_time} seconds')
-
-        # create map between joint name and triangle centroids it is closest to
-        joint_to_tri_v_idx_and_dist: DefaultDict[str, List[Tuple[npt.NDArray[np.int32], np.int32]]] = defaultdict(list)
-        for tri_v_idx in self.mesh['triangles']:
-            tri_verts = np.array([self.mesh['vertices'][v_idx] for v_idx in tri_v_idx])
-            centroid_x, centroid_y = list((tri_verts.mean(axis=0) * self.img_dim).round().astype(np.int32))
-            tri_centroid_closest_joint_idx: np.int8 = closest_joint_idx[centroid_x, centroid_y]
-            dist_from_tri_centroid_to_bone: np.int32 = shortest_distance[centroid_x, centroid_y]
-            joint_to_tri_v_idx_and_dist[joint_name_to_idx[tri_centroid_closest_joint_idx]].append((tri_v_idx, dist_from_tri_centroid_to_bone))
-
+            bone_seeds_xy = (self.mask_dim * np.linspace(dist_joint_xy, prox_joint_xy, num=20, endpoint=False)).round()
+            seeds.append(bone_seeds_xy.astype(np.int64))
+            seeds_joint_idx.extend([joint_name_to_idx.index(joint['name'])] * len(bone_seeds_xy))
+        seeds_xy = np.concatenate(seeds)
+        in_bounds = ((0 <= seeds_xy) & (seeds_xy < self.mask_dim)).all(axis=1)
+        seeds_xy, seeds_joint_idx_arr = seeds_xy[in_bounds], np.array(seeds_joint_idx, dtype=np.int32)[in_bounds]
+
+        # multi-source shortest paths within the mask (8-connected, diagonal steps cost sqrt(2)).
+        # Seeds are passable even if just outside the mask, so that they still reach the mask pixels next to them
+        costs = np.where(self.mask > 0, 1.0, np.inf)
+        costs[seeds_xy[:, 0], seeds_xy[:, 1]] = 1.0
+        mcp = MCP_Geometric(costs)
+        shortest_distance, traceback = mcp.find_costs(list(map(tuple, seeds_xy)))
+
+        # label each pixel with the joint of the seed its shortest path starts from, by following the predecessor
+        # of each pixel and doubling the distance jumped each pass, until every path has reached its seed
+        offsets: npt.NDArray[np.int64] = np.array(mcp.offsets, dtype=np.int64) @ np.array([self.mask_dim, 1])  # as flat index offsets
+        flat_traceback = traceback.ravel()
+        predecessor = np.arange(flat_traceback.size, dtype=np.int64)
+        has_predecessor = flat_traceback >= 0
+        predecessor[has_predecessor] -= offsets[flat_traceback[has_predecessor]]
+        while True:
+            next_predecessor = predecessor[predecessor]
+            if (next_predecessor == predecessor).all():
+                break
+            predecessor = next_predecessor
+
+        seed_joint_idx = np.full(flat_traceback.size, -1, dtype=np.int32)
+        write_order = np.argsort(-seeds_joint_idx_arr, kind='stable')  # if seeds coincide, lowest joint idx is written last
+        seed_joint_idx[seeds_xy[write_order, 0] * self.mask_dim + seeds_xy[write_order, 1]] = seeds_joint_idx_arr[write_order]
+        closest_joint_idx = seed_joint_idx[predecessor].reshape(self.mask.shape)
+
+        # pixels not reached (e.g. outside the mask, where some triangle centroids lie) take the values of the nearest reached pixel
+        unreached = traceback == -2
+        if unreached.any() and not unreached.all():
+            nearest_reached = ndimage.distance_transform_edt(unreached, return_distances=False, return_indices=True)
+            closest_joint_idx = closest_joint_idx[nearest_reached[0], nearest_reached[1]]
+            shortest_distance = shortest_distance[nearest_reached[0], nearest_reached[1]]
+
+        # look up the closest joint, and distance to it, of each triangle's centroid
+        triangles: npt.NDArray[np.int32] = np.array(self.mesh['triangles'], dtype=np.int32).reshape([-1, 3])
+        centroids_xy = (self.mesh['vertices'][triangles].mean(axis=1) * self.mask_dim).round().astype(np.int32)
+        tri_closest_joint_idx = closest_joint_idx[centroids_xy[:, 0], centroids_xy[:, 1]]
+        tri_distance_to_bone = shortest_distance[centroids_xy[:, 0], centroids_xy[:, 1]]
+
+        # create map between joint name and the triangles closest to it, sorted by distance, descending
         joint_to_tri_v_idx: Dict[str, npt.NDArray[np.int32]] = {}
-        for key, val in joint_to_tri_v_idx_and_dist.items():
-            # sort by distance, descending
-            val.sort(key=lambda x: float(x[1]), reverse=True)
-
-            # retain vertex indices, remove distance info
-            val = [v[0] for v in val]
-
-            # convert to np array and save in dictionary
-            joint_to_tri_v_idx[key] = np.array(val).flatten()  # type: ignore
+        _, first_tri_idxs = np.unique(tri_closest_joint_idx, return_index=True)
+        for joint_idx in tri_closest_joint_idx[np.sort(first_tri_idxs)]:
+            tri_idxs = np.flatnonzero(tri_closest_joint_idx == joint_idx)
+            tri_idxs = tri_idxs[np.argsort(-tri_distance_to_bone[tri_idxs], kind='stable')]
+            joint_to_tri_v_idx[joint_name_to_idx[joint_idx]] = triangles[tri_idxs].flatten()
 
         self.joint_to_tri_v_idx = joint_to_tri_v_idx
 
@@ -520,17 +700,75 @@ class AnimatedDrawing(Transform, TimeManager):
             logging.critical(msg)
             assert False, msg
 
-        _txtr = np.rot90(_txtr, 3, )  # rotate to upright
+        # Only the part of the drawing covered by the mask is ever sampled, so crop to the mask's bounding box
+        # (plus a pixel, for texture filtering). Unlike the mask, the texture is not rotated upright or padded to square.
+        # Instead, texture coordinates account for the crop and rotation (see _initialize_vertices())
+        raw_mask = np.rot90(self.mask[:_txtr.shape[1], :_txtr.shape[0]], 1)  # undo the rotation applied in _load_mask()
+        rows, cols = np.flatnonzero(raw_mask.any(axis=1)), np.flatnonzero(raw_mask.any(axis=0))
+        if len(rows) == 0:
+            rows, cols = np.array([0, _txtr.shape[0] - 1]), np.array([0, _txtr.shape[1] - 1])
+        top, bottom = max(rows[0] - 1, 0), min(rows[-1] + 2, _txtr.shape[0])
+        left, right = max(cols[0] - 1, 0), min(cols[-1] + 2, _txtr.shape[1])
 
-        # pad to square
-        txtr = np.zeros([self.img_dim, self.img_dim, _txtr.shape[-1]], _txtr.dtype)
-        txtr[0:_txtr.shape[0], 0:_txtr.shape[1], :] = _txtr
+        self.txtr_origin: Tuple[int, int] = (int(top), int(left))  # row and column within the drawing of the texture's first pixel
+        return np.ascontiguousarray(_txtr[top:bottom, left:right])
 
-        txtr[np.where(self.mask == 0)][:, 3] = 0  # make pixels outside mask transparent
+    def _generate_mesh(self) -> None:
+        """
+        Creates the character's mesh (and, if used, the coarser ARAP control mesh) from its mask.
+        If cache_dir was specified, meshes are loaded from, or saved to, a cache file keyed by the mask's content.
+        """
+        cache_file: Optional[Path] = None
+        if self.cache_dir is not None:
+            cache_file = Path(self.cache_dir, f'mesh_{self._get_mesh_cache_key()}.npz')
 
-        return txtr
+        cached: Optional[Dict[str, npt.NDArray]] = None if cache_file is None else read_cache_file(cache_file)
+        if cached is not None:
+            self._load_meshes(cached)
+            return
 
-    def _generate_mesh(self) -> None:
+        self._compute_meshes()
+
+        if cache_file is not None:
+            write_cache_file(cache_file, self._dump_meshes(), self.cache_max_mb)
+
+    def _get_mesh_cache_key(self) -> str:
+        """ Returns a hex digest uniquely identifying the inputs which determine the generated meshes. """
+        h = hashlib.sha256()
+        h.update(f'{self.MESH_CACHE_VERSION}_{self.img_dim}_{self.arap_control_mesh_density}_{self.mesh_max_vertices}'.encode())
+        h.update(str(self.mask.shape).encode())
+        h.update(np.ascontiguousarray(self.mask).tobytes())
+        if self.arap_control_mesh_density is not None:  # joints are control mesh vertices
+            h.update(np.ascontiguousarray(self.rig.get_joints_2D_positions(), dtype=np.float64).tobytes())
+        return h.hexdigest()
+
+    def _dump_meshes(self) -> Dict[str, npt.NDArray]:
+        """ Returns the generated meshes as a flat dictionary of arrays, suitable for np.savez. """
+        arrays: Dict[str, npt.NDArray] = {
+            'vertices': self.mesh['vertices'],
+            'triangles': np.array(self.mesh['triangles'], dtype=np.int32).reshape([-1, 3]),
+        }
+        if self.arap_to_mesh is not None:
+            arrays['arap_vertices'] = self.arap_mesh['vertices']
+            arrays['arap_triangles'] = np.array(self.arap_mesh['triangles'], dtype=np.int32).reshape([-1, 3])
+            arrays['arap_to_mesh_data'] = self.arap_to_mesh.data
+            arrays['arap_to_mesh_indices'] = self.arap_to_mesh.indices
+            arrays['arap_to_mesh_indptr'] = self.arap_to_mesh.indptr
+            arrays['arap_to_mesh_shape'] = np.array(self.arap_to_mesh.shape)
+        return arrays
+
+    def _load_meshes(self, arrays: Dict[str, npt.NDArray]) -> None:
+        """ Restores the meshes from a dictionary created by _dump_meshes(). """
+        self.mesh = {'vertices': arrays['vertices'], 'triangles': list(arrays['triangles'])}
+        if 'arap_vertices' not in arrays:
+            self.arap_mesh = self.mesh
+            return
+
+        self.arap_mesh = {'vertices': arrays['arap_vertices'], 'triangles': list(arrays['arap_triangles'])}
+        self.arap_to_mesh = csr_matrix((arrays['arap_to_mesh_data'], arrays['arap_to_mesh_indices'], arrays['arap_to_mesh_indptr']),
+                                       shape=tuple(arrays['arap_to_mesh_shape']))
+
+    def _compute_meshes(self) -> None:
         try:
             contours: List[npt.NDArray[np.float64]] = measure.find_contours(self.mask, 128)
         except Exception as e:
@@ -544,20 +782,40 @@ class AnimatedDrawing(Transform, TimeManager):
             logging.info(msg)
             contours.sort(key=len, reverse=True)
 
-        outside_vertices: npt.NDArray[np.float64] = measure.approximate_polygon(contours[0], tolerance=0.25)
-        character_outline = geometry.Polygon(contours[0])
+        outline_tolerance, grid_density = 0.25, 40
+        if self.mesh_max_vertices is not None:
+            outline_tolerance, grid_density = self._get_mesh_parameters_for_budget(contours[0], self.mesh_max_vertices)
+        self.mesh = self._triangulate_contour(contours[0], outline_tolerance=outline_tolerance, grid_density=grid_density)
 
-        # add some internal vertices to ensure a good mesh is created
-        inside_vertices_xy: List[Tuple[np.float32, np.float32]] = []
-        _x = np.linspace(0, self.img_dim, 40)
-        _y = np.linspace(0, self.img_dim, 40)
-        xv, yv = np.meshgrid(_x, _y)
-        for x, y in zip(xv.flatten(), yv.flatten()):
-            if character_outline.contains(geometry.Point(x, y)):
-                inside_vertices_xy.append((x, y))
-        inside_vertices: npt.NDArray[np.float64] = np.array(inside_vertices_xy)
+        if self.arap_control_mesh_density is None:
+            self.arap_mesh = self.mesh
+            return
 
-        vertices: npt.NDArray[np.float32] = np.concatenate([outside_vertices, inside_vertices]).astype(np.float32)
+        # coarser control mesh for ARAP: simplify the outline by up to half an interior grid cell, but keep outline vertices
+        # at most a grid cell apart so that thin parts (e.g. legs) still get triangles between their two sides.
+        # Joints become vertices so that they stay inside the mesh and pin it, even after the outline is simplified
+        cell_size: float = self.mask_dim / self.arap_control_mesh_density
+        self.arap_mesh = self._triangulate_contour(contours[0],
+                                                   outline_tolerance=0.5 * cell_size,
+                                                   grid_density=self.arap_control_mesh_density,
+                                                   max_outline_segment_length=cell_size,
+                                                   extra_vertices=self.rig.get_joints_2D_positions() * self.mask_dim)
+        self.arap_to_mesh = get_barycentric_interpolation_matrix(self.mesh['vertices'], self.arap_mesh['vertices'], self.arap_mesh['triangles'],
+                                                                 points_triangles=self.mesh['triangles'])
+
+    def _triangulate_contour(self,
+                             contour: npt.NDArray[np.float64],
+                             outline_tolerance: float,
+                             grid_density: int,
+                             extra_vertices: Optional[npt.NDArray[np.float32]] = None,
+                             max_outline_segment_length: Optional[float] = None
+                             ) -> AnimatedDrawingMesh:
+        """
+        Creates a mesh from the character outline. See _sample_mesh_vertices() for parameters.
+        """
+        vertices: npt.NDArray[np.float32] = self._sample_mesh_vertices(contour, outline_tolerance, grid_density,
+                                                                       extra_vertices, max_outline_segment_length)
+        character_outline = geometry.Polygon(contour)
 
         """
         Create a convex hull containing the character.
@@ -565,17 +823,102 @@ class AnimatedDrawing(Transform, TimeManager):
         falls outside the character's outline.
         """
         convex_hull_triangles = Delaunay(vertices)
-        triangles: List[npt.NDArray[np.int32]] = []
-        for _triangle in convex_hull_triangles.simplices:
-            tri_vertices = np.array(
-                [vertices[_triangle[0]], vertices[_triangle[1]], vertices[_triangle[2]]])
-            tri_centroid = geometry.Point(np.mean(tri_vertices, 0))
-            if character_outline.contains(tri_centroid):
-                triangles.append(_triangle)
+        tri_centroids: npt.NDArray[np.float32] = vertices[convex_hull_triangles.simplices].mean(axis=1)
+        keep = vectorized.contains(character_outline, tri_centroids[:, 0], tri_centroids[:, 1])
+        vertices, triangles_arr = self._reorder_mesh(vertices, convex_hull_triangles.simplices[keep])
+        triangles: List[npt.NDArray[np.int32]] = list(triangles_arr)
+
+        vertices /= self.mask_dim  # scale vertices so they lie between 0-1
+
+        return {'vertices': vertices, 'triangles': triangles}
 
-        vertices /= self.img_dim  # scale vertices so they lie between 0-1
+    @staticmethod
+    def _reorder_mesh(vertices: npt.NDArray[np.float32], triangles: npt.NDArray[np.int32]
+                      ) -> Tuple[npt.NDArray[np.float32], npt.NDArray[np.int32]]:
+        """
+        Delaunay returns vertices and triangles in no useful order. Renumbers vertices with reverse Cuthill-McKee, so that
+        vertices sharing an edge have nearby indices (reducing the bandwidth of ARAP's matrices), then sorts triangles by
+        their vertices, so that consecutive triangles reference nearby vertices (improving vertex cache locality when drawn).
+        vertices: ndarray [V, 2]
+        triangles: ndarray [T, 3] of vertex ids making up each triangle
+        return: reordered vertices [V, 2] and triangles [T, 3]
+        """
+        edges = np.concatenate([triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]]])
+        adjacency = csr_matrix((np.ones(len(edges), dtype=np.int8), (edges[:, 0], edges[:, 1])), shape=(len(vertices), len(vertices)))
+        new_to_old_v_idx = csgraph.reverse_cuthill_mckee(adjacency, symmetric_mode=False)
+
+        old_to_new_v_idx = np.empty_like(new_to_old_v_idx)
+        old_to_new_v_idx[new_to_old_v_idx] = np.arange(len(new_to_old_v_idx), dtype=new_to_old_v_idx.dtype)
+        triangles = old_to_new_v_idx[triangles].astype(np.int32)
+
+        sorted_triangles = np.sort(triangles, axis=1)
+        triangles = triangles[np.lexsort(sorted_triangles.T[::-1])]  # by lowest vertex id, then middle, then highest
+
+        return vertices[new_to_old_v_idx], triangles
+
+    def _sample_mesh_vertices(self,
+                              contour: npt.NDArray[np.float64],
+                              outline_tolerance: float,
+                              grid_density: int,
+                              extra_vertices: Optional[npt.NDArray[np.float32]] = None,
+                              max_outline_segment_length: Optional[float] = None
+                              ) -> npt.NDArray[np.float32]:
+        """
+        Returns ndarray [V, 2] of mesh vertex positions, in pixels: a simplified outline plus a grid of inside points.
+        contour: ndarray [N, 2] of outline points, in pixels
+        outline_tolerance: max distance, in pixels, between the outline and the simplified polygon used for outside vertices
+        grid_density: number of points per side of the grid from which inside vertices are sampled
+        extra_vertices: optional ndarray [M, 2] of additional points, in pixels, to use as vertices if inside the outline
+        max_outline_segment_length: if set, simplified outline segments longer than this, in pixels, are subdivided
+        """
+        outside_vertices: npt.NDArray[np.float64] = measure.approximate_polygon(contour, tolerance=outline_tolerance)
+        if max_outline_segment_length is not None:
+            subdivided: List[npt.NDArray[np.float64]] = []
+            for start, end in zip(outside_vertices[:-1], outside_vertices[1:]):
+                n = max(1, int(np.ceil(np.linalg.norm(end - start) / max_outline_segment_length)))
+                subdivided.extend(start + (end - start) * i / n for i in range(n))
+            subdivided.append(outside_vertices[-1])
+            outside_vertices = np.array(subdivided)
+        character_outline = geometry.Polygon(contour)
 
-        self.mesh = {'vertices': vertices, 'triangles': triangles}
+        # add some internal vertices to ensure a good mesh is created
+        _x = np.linspace(0, self.mask_dim, grid_density)
+        _y = np.linspace(0, self.mask_dim, grid_density)
+        xv, yv = np.meshgrid(_x, _y)
+        _xy = np.stack([xv.flatten(), yv.flatten()], axis=1)
+        if extra_vertices is not None:
+            _xy = np.concatenate([_xy, extra_vertices])
+        inside_vertices: npt.NDArray[np.float64] = _xy[vectorized.contains(character_outline, _xy[:, 0], _xy[:, 1])]
+
+        return np.concatenate([outside_vertices, inside_vertices]).astype(np.float32)
+
+    def _get_mesh_parameters_for_budget(self, contour: npt.NDArray[np.float64], max_vertices: int) -> Tuple[float, int]:
+        """
+        Returns the outline tolerance and interior grid density with which to triangulate contour so that the mesh has
+        at most max_vertices vertices. Starting from the defaults, the tolerance is increased and the density decreased
+        together, by the same factor, until the budget is met.
+        """
+        scale = 1.0
+        while True:
+            outline_tolerance, grid_density = 0.25 * scale, max(2, round(40 / scale))
+            vertex_count = len(self._sample_mesh_vertices(contour, outline_tolerance, grid_density))
+            if vertex_count <= max_vertices:
+                break
+            if outline_tolerance > self.mask_dim:
+                msg = f'Could not simplify character mesh to {max_vertices} vertices. Using {vertex_count} vertices.'
+                logging.warning(msg)
+                break
+            scale *= 1.25
+
+        if scale > 1.0:
+            logging.info(f'Simplified character mesh to {vertex_count} vertices: outline tolerance {outline_tolerance:.2f}, grid density {grid_density}')
+        return outline_tolerance, grid_density
+
+    def _arap_to_mesh_vertices(self, arap_vertices_xy: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+        """ Given xy positions of arap_mesh vertices [V_arap, 2], returns xy positions of render mesh vertices [V, 2]. """
+        if self.arap_to_mesh is None:
+            return arap_vertices_xy
+        return self.arap_to_mesh @ arap_vertices_xy
 
     def _initialize_vertices(self) -> None:
         """
@@ -585,11 +928,17 @@ class AnimatedDrawing(Transform, TimeManager):
         self.vertices = np.zeros((self.mesh['vertices'].shape[0], 8), np.float32)
 
         # initialize xy positions of mesh vertices
-        self.vertices[:, :2] = self.arap.solve(self.rig.get_joints_2D_positions()).reshape([-1, 2])
-
-        # initialize texture coordinates
-        self.vertices[:, 6] = self.mesh['vertices'][:, 1]                        # u tex
-        self.vertices[:, 7] = self.mesh['vertices'][:, 0]                        # v tex
+        self.vertices[:, :2] = self._arap_to_mesh_vertices(self.arap.solve(self.rig.get_joints_2D_positions())).reshape([-1, 2])
+
+        # initialize texture coordinates. Mesh vertices are in the upright drawing, normalized by img_dim, while the texture
+        # is a crop of the drawing as stored (see _load_txtr()): upright rows are drawing columns, and upright columns are
+        # drawing rows, in reverse order
+        txtr_h, txtr_w, _ = self.txtr.shape
+        txtr_top, txtr_left = self.txtr_origin
+        upright_row = self.mesh['vertices'][:, 0] * self.img_dim
+        upright_col = self.mesh['vertices'][:, 1] * self.img_dim
+        self.vertices[:, 6] = (upright_row - txtr_left) / txtr_w                           # u tex
+        self.vertices[:, 7] = (self.char_cfg.img_height - upright_col - txtr_top) / txtr_h  # v tex
 
         # set per-joint triangle colors
         color_set: set[Tuple[np.float32, np.float32, np.float32]] = set()
@@ -612,6 +961,8 @@ class AnimatedDrawing(Transform, TimeManager):
         GL.glBindTexture(GL.GL_TEXTURE_2D, self.txtr_id)
         GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_BASE_LEVEL, 0)
         GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAX_LEVEL, 0)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)  # texture is cropped, so don't wrap
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
         GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGBA, w, h,
                         0, GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, self.txtr)
 
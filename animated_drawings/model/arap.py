@@ -4,11 +4,16 @@
 
 import numpy as np
 import numpy.typing as npt
-from collections import defaultdict
 import logging
-from typing import List, Dict, Set, Tuple
+import hashlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Tuple, Optional, Union
+import scipy.linalg
 import scipy.sparse.linalg as spla
 import scipy.sparse as sp
+from scipy.sparse import csgraph
+from animated_drawings.utils import read_cache_file, write_cache_file
 
 
 csr_matrix = sp._csr.csr_matrix  # for typing  # pyright: ignore[reportPrivateUsage]
@@ -38,7 +43,20 @@ class ARAP():
     between (e' in E') and (e in E). This way, rotation is essentially free, while scaling is not.
     """
 
-    def __init__(self, pins_xy: npt.NDArray[np.float32], triangles: List[npt.NDArray[np.int32]], vertices: npt.NDArray[np.float32], w: int = 1000):  # noqa: C901
+    # bump whenever the contents or meaning of the cached precomputation change, so stale cache files are ignored
+    CACHE_VERSION: int = 2
+
+    # sparse matrices stored in cache files, in addition to the edge and pin arrays
+    _CACHED_MATRICES: Tuple[str, ...] = ('tA1', 'tA2', 'G', 'tA1xA1', 'tA2xA2')
+
+    def __init__(self,
+                 pins_xy: npt.NDArray[np.float32],
+                 triangles: List[npt.NDArray[np.int32]],
+                 vertices: npt.NDArray[np.float32],
+                 w: int = 1000,
+                 cache_dir: Optional[str] = None,
+                 cache_max_mb: float = 1024
+                 ):
         """
         Sets up the matrices needed for later solves.
 
@@ -46,126 +64,311 @@ class ARAP():
         vertices: ndarray [N, 2] containing xy positions of N vertices. A vertex's order within array is it's vertex ID
         triangles: ndarray [N, 3] triplets of vertex IDs that make up triangles comprising the mesh
         w: int the weights to use for control points in solve. Default value should work.
+        cache_dir: if specified, the precomputed matrices are loaded from (or saved to) this directory,
+            keyed by a hash of pins_xy, triangles, vertices and w.
+        cache_max_mb: after saving, least recently used files in cache_dir are evicted until it is at most this size.
         """
         self.w = w
 
         self.vertices = np.copy(vertices)
 
-        # build a deduplicated list of edge->vertex IDS...
-        self.e_v_idxs: List[Tuple[np.int32, np.int32]] = []
-        for v0, v1, v2 in triangles:
-            self.e_v_idxs.append(tuple(sorted((v0, v1))))
-            self.e_v_idxs.append(tuple(sorted((v1, v2))))
-            self.e_v_idxs.append(tuple(sorted((v2, v0))))
-        self.e_v_idxs = list(set(self.e_v_idxs))  # ...and deduplicate it
-
-        # build list of edge vectors
-        _edge_vectors: List[npt.NDArray[np.float32]] = []
-        for vi_idx, vj_idx in self.e_v_idxs:
-            vi = self.vertices[vi_idx]
-            vj = self.vertices[vj_idx]
-            _edge_vectors.append(vj - vi)
-        self.edge_vectors: npt.NDArray[np.float32] = np.array(_edge_vectors)
+        self.tris: npt.NDArray[np.int64] = np.asarray(triangles, dtype=np.int64).reshape([-1, 3])
+        tris = self.tris
 
-        # get barycentric coordinates of pins, and mask denoting which pins were initially outside the mesh
-        pins_bc: List[Tuple[Tuple[np.int32, np.float32], Tuple[np.int32, np.float32], Tuple[np.int32, np.float32]]]
-        self.pin_mask = npt.NDArray[np.bool8]
-        pins_bc, self.pin_mask = self._xy_to_barycentric_coords(pins_xy, vertices, triangles)
+        cache_file: Optional[Path] = None
+        if cache_dir is not None:
+            cache_file = Path(cache_dir, f'arap_{self._get_cache_key(pins_xy, tris, self.vertices, w)}.npz')
+
+        cached: Optional[Dict[str, npt.NDArray]] = None if cache_file is None else read_cache_file(cache_file)
+        if cached is not None:
+            self._load_precomputation(cached)
+        else:
+            self._precompute(pins_xy, tris)
+
+        self._init_solver()
+
+        if cache_file is not None and cached is None:
+            write_cache_file(cache_file, self._dump_precomputation(), cache_max_mb)
+
+    def _init_solver(self) -> None:
+        """
+        Factorizes the normal matrices and sets up the solver state. Called by __init__() and BlockDiagonalARAP, once the system matrices,
+        the pin bindings (pins_v_idxs, pins_bc) and the edge, vertex and pin counts have been set.
+        """
+        # Neither normal matrix changes after init, so factorize once and only back-substitute during solves.
+        # Singular matrices are detected by the factorization itself and regularized there.
+        # If the pins are later changed with update_pins(), these factorizations are corrected rather than recomputed.
+        self.tA1xA1_lu: Union[spla.SuperLU, WoodburyLU]
+        self.tA1xA1, self.tA1xA1_lu = self._factorize(self.tA1xA1, 'tA1xA1')
+
+        self.tA2xA2_lu: Union[spla.SuperLU, WoodburyLU]
+        self.tA2xA2, self.tA2xA2_lu = self._factorize(self.tA2xA2, 'tA2xA2')
+
+        # pin bindings, normal matrices and factorizations as of the last full factorization. Used by update_pins()
+        self._factorized_pins_v_idxs: npt.NDArray[np.int64] = self.pins_v_idxs
+        self._factorized_pins_bc: npt.NDArray[np.float64] = self.pins_bc
+        self._factorized_tA1xA1: csr_matrix = self.tA1xA1
+        self._factorized_tA2xA2: csr_matrix = self.tA2xA2
+        self._factorized_tA1xA1_lu: spla.SuperLU = self.tA1xA1_lu
+        self._factorized_tA2xA2_lu: spla.SuperLU = self.tA2xA2_lu
+
+        # LRU cache of solve() results. Disabled until set_result_cache() is called
+        self.set_result_cache(0)
+
+    def _precompute(self, pins_xy: npt.NDArray[np.float32], tris: npt.NDArray[np.int64]) -> None:
+        """
+        Builds the edge list, the system matrices, the edge rotation matrix G, and the (not yet factorized) normal matrices.
+        tris: ndarray [T, 3] triplets of vertex IDs that make up triangles comprising the mesh
+        """
+        # build a deduplicated array of edge->vertex IDS, [E, 2], with lower vertex ID first
+        _e_v_idxs = np.concatenate([tris[:, [0, 1]], tris[:, [1, 2]], tris[:, [2, 0]]])
+        self.e_v_idxs: npt.NDArray[np.int64] = np.unique(np.sort(_e_v_idxs, axis=1), axis=0)
 
-        v_vnbr_idxs: Dict[np.int32, Set[np.int32]] = defaultdict(set)  # build a dict mapping vertex ID -> neighbor vertex IDs
-        for v0, v1, v2 in triangles:
-            v_vnbr_idxs[v0] |= {v1, v2}
-            v_vnbr_idxs[v1] |= {v2, v0}
-            v_vnbr_idxs[v2] |= {v0, v1}
+        # build array of edge vectors
+        self.edge_vectors: npt.NDArray[np.float32] = self.vertices[self.e_v_idxs[:, 1]] - self.vertices[self.e_v_idxs[:, 0]]
+
+        # get barycentric coordinates of pins, and mask denoting which pins were initially outside the mesh
+        self.pins_v_idxs: npt.NDArray[np.int64]  # [P, 3] IDs of the vertices of the triangle containing each pin
+        self.pins_bc: npt.NDArray[np.float64]    # [P, 3] barycentric coordinates of each pin wrt those vertices
+        self.pin_mask: npt.NDArray[np.bool8]
+        self.pins_v_idxs, self.pins_bc, self.pin_mask = self._xy_to_barycentric_coords(pins_xy, self.vertices, tris)
 
         self.edge_num = len(self.e_v_idxs)
         self.vert_num = len(self.vertices)
         self.pin_num = len(pins_xy[self.pin_mask])
 
-        self.A1: npt.NDArray[np.float32] = np.zeros([2 * (self.edge_num + self.pin_num), 2 * self.vert_num], dtype=np.float32)
-        G: npt.NDArray[np.float32] = np.zeros([2 * self.edge_num, 2 * self.vert_num], dtype=np.float32)  # holds edge rotation calculations
-
-        # populate top half of A1, one row per edge
-        for k, (vi_idx, vj_idx) in enumerate(self.e_v_idxs):
-
-            # initialize self.A1 with 1, -1 denoting beginning and end of x and y dims of vector
-            self.A1[2*k:2*(k+1), 2*vi_idx:2*(vi_idx+1)] = -np.identity(2)
-            self.A1[2*k:2*(k+1), 2*vj_idx:2*(vj_idx+1)] = np.identity(2)
-
-            # Find the 'neighbor' vertices for this edge: {v_i, v_j,v_r, v_l}
-            vi_vnbr_idxs: Set[np.int32] = v_vnbr_idxs[vi_idx]
-            vj_vnbr_idxs: Set[np.int32] = v_vnbr_idxs[vj_idx]
-            e_vnbr_idxs: List[np.int32] = list(vi_vnbr_idxs.intersection(vj_vnbr_idxs))
-            e_vnbr_idxs.insert(0, vi_idx)
-            e_vnbr_idxs.insert(1, vj_idx)
-
-            e_vnbr_xys: Tuple[np.float32, np.float32] = tuple([self.vertices[v_idx] for v_idx in e_vnbr_idxs])
-
-            _: List[Tuple[float, float]] = []
-            for v in e_vnbr_xys[1:]:
-                vx: float = v[0] - e_vnbr_xys[0][0]
-                vy: float = v[1] - e_vnbr_xys[0][1]
-                _.extend(((vx, vy), (vy, -vx)))
-            G_k: npt.NDArray[np.float32] = np.array(_)
-
-            G_k_star: npt.NDArray[np.float32] = np.linalg.inv(G_k.T @ G_k) @ G_k.T
-
-            e_kx, e_ky = self.edge_vectors[k]
-            e = np.array([
-                [e_kx,  e_ky],
-                [e_ky, -e_kx]
-            ], np.float32)
-
-            edge_matrix = np.hstack([np.tile(-np.identity(2), (len(e_vnbr_idxs)-1, 1)), np.identity(2*(len(e_vnbr_idxs)-1))])
-            g = np.dot(G_k_star, edge_matrix)
-            h = np.dot(e, g)
-
-            for h_offset, v_idx in enumerate(e_vnbr_idxs):
-                self.A1[2*k:2*(k+1), 2*v_idx:2*(v_idx+1)] -= h[:, 2*h_offset:2*(h_offset+1)]
-                G[2*k:2*(k+1), 2*v_idx:2*(v_idx+1)] = g[:, 2*h_offset:2*(h_offset+1)]
-
-        # populate bottom row of A1, one row per constraint-dimension
-        for pin_idx, pin_bc in enumerate(pins_bc):
-            for v_idx, v_w in pin_bc:
-                self.A1[2*self.edge_num + 2*pin_idx  , 2*v_idx]     = self.w * v_w  # x component
-                self.A1[2*self.edge_num + 2*pin_idx+1, 2*v_idx + 1] = self.w * v_w  # y component
-
-        A2_top: npt.NDArray[np.float32] = np.zeros([self.edge_num, self.vert_num], dtype=np.float32)
-        for k, (vi_idx, vj_idx) in enumerate(self.e_v_idxs):
-            A2_top[k, vi_idx] = -1
-            A2_top[k, vj_idx] = 1
-
-        A2_bot: npt.NDArray[np.float32] = np.zeros([self.pin_num, self.vert_num], dtype=np.float32)
-        for pin_idx, pin_bc in enumerate(pins_bc):
-            for v_idx, v_w in pin_bc:
-                A2_bot[pin_idx, v_idx] = self.w * v_w
-
-        self.A2: npt.NDArray[np.float32] = np.vstack([A2_top, A2_bot])
-
-        # for speed, convert to sparse matrices and cache for later
-        self.tA1: csr_matrix = sp.csr_matrix(self.A1.transpose())
-        self.tA2: csr_matrix = sp.csr_matrix(self.A2.transpose())
-        self.G: csr_matrix = sp.csr_matrix(G)
-
-        # perturbing singular matrix and calling det can trigger overflow warning- ignore it
-        old_settings = np.seterr(over='ignore')
-
-        # ensure tA1xA1 matrix isn't singular and cache sparse repsentation
-        tA1xA1_dense: npt.NDArray[np.float32] = self.tA1 @ self.A1
-        while np.linalg.det(tA1xA1_dense) == 0.0:
-            logging.info('tA1xA1 is singular. perturbing...')
-            tA1xA1_dense += 0.00000001 * np.identity(tA1xA1_dense.shape[0])
-        self.tA1xA1: csr_matrix = sp.csr_matrix(tA1xA1_dense)
-
-        # ensure tA2xA2 matrix isn't singular and cache sparse repsentation
-        tA2xA2_dense: npt.NDArray[np.float32] = self.tA2 @ self.A2
-        while np.linalg.det(tA2xA2_dense) == 0.0:
-            logging.info('tA2xA2 is singular. perturbing...')
-            tA2xA2_dense += 0.00000001 * np.identity(tA2xA2_dense.shape[0])
-        self.tA2xA2: csr_matrix = sp.csr_matrix(tA2xA2_dense)
-
-        # revert np overflow warnings behavior
-        np.seterr(**old_settings)
+        # A1 and G are assembled as (row, col, val) triplets so memory scales with nonzeros, not vertex count squared.
+        # Duplicate A1 entries are summed when converted to CSR.
+        A1_rows: List[npt.NDArray[np.int64]] = []
+        A1_cols: List[npt.NDArray[np.int64]] = []
+        A1_vals: List[npt.NDArray[np.float64]] = []
+        G_rows: List[npt.NDArray[np.int64]] = []
+        G_cols: List[npt.NDArray[np.int64]] = []
+        G_vals: List[npt.NDArray[np.float64]] = []
+
+        # populate top half of A1, two rows per edge. Initialize with 1, -1 denoting beginning and end of x and y dims of vector
+        e_idxs: npt.NDArray[np.int64] = np.arange(self.edge_num)
+        for dim in range(2):
+            A1_rows.extend([2*e_idxs + dim, 2*e_idxs + dim])
+            A1_cols.extend([2*self.e_v_idxs[:, 0] + dim, 2*self.e_v_idxs[:, 1] + dim])
+            A1_vals.extend([np.full(self.edge_num, -1.0), np.full(self.edge_num, 1.0)])
+
+        # Find the 'neighbor' vertices for each edge, {v_i, v_j, v_r, v_l}: the vertices adjacent to both v_i and v_j.
+        # Boundary edges have one such vertex, interior edges have two. Batch together edges with the same count.
+        adj: csr_matrix = sp.csr_matrix((np.ones(6 * len(tris)), (tris[:, [0, 1, 1, 2, 2, 0]].reshape(-1), tris[:, [1, 0, 2, 1, 0, 2]].reshape(-1))),
+                                        shape=(self.vert_num, self.vert_num))
+        adj.data[:] = 1.0
+        common_nbrs: csr_matrix = adj[self.e_v_idxs[:, 0]].multiply(adj[self.e_v_idxs[:, 1]]).tocsr()
+        common_nbrs.sort_indices()
+        common_nbr_counts: npt.NDArray[np.int64] = np.diff(common_nbrs.indptr)
+
+        for nbr_count in np.unique(common_nbr_counts):
+            k: npt.NDArray[np.int64] = np.flatnonzero(common_nbr_counts == nbr_count)  # IDs of edges in this batch
+            nbr_idxs = common_nbrs.indices[common_nbrs.indptr[k][:, None] + np.arange(nbr_count)]
+            e_vnbr_idxs: npt.NDArray[np.int64] = np.hstack([self.e_v_idxs[k], nbr_idxs])  # [B, m]
+            m: int = e_vnbr_idxs.shape[1]
+
+            # G_k is built from the vectors between v_i and each other vertex, two rows per vector: [B, 2(m-1), 2]
+            e_vnbr_xys = self.vertices[e_vnbr_idxs]
+            d = e_vnbr_xys[:, 1:] - e_vnbr_xys[:, :1]
+            G_k = np.stack([d, np.stack([d[..., 1], -d[..., 0]], axis=-1)], axis=2).reshape([len(k), 2*(m-1), 2])
+            G_k_T = G_k.transpose(0, 2, 1)
+
+            G_k_star = np.linalg.solve(G_k_T @ G_k, G_k_T)  # [B, 2, 2(m-1)]
+
+            # equivalent to G_k_star @ edge_matrix: v_i's block is the negated sum of the other vertices' blocks
+            g = np.concatenate([-G_k_star.reshape([len(k), 2, m-1, 2]).sum(axis=2), G_k_star], axis=2)  # [B, 2, 2m]
+
+            e_kx, e_ky = self.edge_vectors[k, 0], self.edge_vectors[k, 1]
+            e = np.stack([np.stack([e_kx,  e_ky], axis=-1),
+                          np.stack([e_ky, -e_kx], axis=-1)], axis=1)  # [B, 2, 2]
+            h = e @ g
+
+            # scatter each vertex's 2x2 block into rows 2k, 2k+1 and columns 2v, 2v+1
+            rows = np.broadcast_to(2*k[:, None, None] + np.array([0, 0, 1, 1]), (len(k), m, 4))
+            cols = 2*e_vnbr_idxs[:, :, None] + np.array([0, 1, 0, 1])
+            A1_rows.append(rows.reshape(-1))
+            A1_cols.append(cols.reshape(-1))
+            A1_vals.append(-h.reshape([len(k), 2, m, 2]).transpose(0, 2, 1, 3).reshape(-1))
+            G_rows.append(rows.reshape(-1))
+            G_cols.append(cols.reshape(-1))
+            G_vals.append(g.reshape([len(k), 2, m, 2]).transpose(0, 2, 1, 3).reshape(-1))
+
+        # A2 top half, one row per edge
+        A2_rows: List[npt.NDArray[np.int64]] = [np.arange(self.edge_num), np.arange(self.edge_num)]
+        A2_cols: List[npt.NDArray[np.int64]] = [self.e_v_idxs[:, 0], self.e_v_idxs[:, 1]]
+        A2_vals: List[npt.NDArray[np.float64]] = [np.full(self.edge_num, -1.0), np.full(self.edge_num, 1.0)]
+
+        # bottom rows of A1 (one row per constraint-dimension) and A2 (one row per constraint)
+        A1_pins, A2_pins = self._get_pin_rows(self.pins_v_idxs, self.pins_bc)
+
+        A1: csr_matrix = sp.vstack([self._triplets_to_csr(A1_rows, A1_cols, A1_vals, (2 * self.edge_num, 2 * self.vert_num)), A1_pins]).tocsr()
+        A2: csr_matrix = sp.vstack([self._triplets_to_csr(A2_rows, A2_cols, A2_vals, (self.edge_num, self.vert_num)), A2_pins]).tocsr()
+
+        # cache for later
+        self.tA1: csr_matrix = A1.transpose().tocsr()
+        self.tA2: csr_matrix = A2.transpose().tocsr()
+        self.G: csr_matrix = self._triplets_to_csr(G_rows, G_cols, G_vals, (2 * self.edge_num, 2 * self.vert_num))  # holds edge rotation calculations
+
+        self.tA1xA1: csr_matrix = (self.tA1 @ A1).tocsr()
+        self.tA2xA2: csr_matrix = (self.tA2 @ A2).tocsr()
+
+    @classmethod
+    def _get_cache_key(cls,
+                       pins_xy: npt.NDArray[np.float32],
+                       tris: npt.NDArray[np.int64],
+                       vertices: npt.NDArray[np.float32],
+                       w: int
+                       ) -> str:
+        """ Returns a hex digest uniquely identifying the inputs which determine the precomputed matrices. """
+        h = hashlib.sha256()
+        h.update(f'{cls.CACHE_VERSION}_{w}'.encode())
+        for a in (np.asarray(pins_xy, dtype=np.float64), tris, np.asarray(vertices, dtype=np.float64)):
+            h.update(str(a.shape).encode())
+            h.update(np.ascontiguousarray(a).tobytes())
+        return h.hexdigest()
+
+    def _dump_precomputation(self) -> Dict[str, npt.NDArray]:
+        """ Returns the precomputed matrices as a flat dictionary of arrays, suitable for np.savez. """
+        arrays: Dict[str, npt.NDArray] = {
+            'e_v_idxs': self.e_v_idxs,
+            'edge_vectors': self.edge_vectors,
+            'pin_mask': self.pin_mask,
+            'pins_v_idxs': self.pins_v_idxs,
+            'pins_bc': self.pins_bc,
+        }
+        for name in self._CACHED_MATRICES:
+            m: csr_matrix = getattr(self, name)
+            arrays[f'{name}_data'] = m.data
+            arrays[f'{name}_indices'] = m.indices
+            arrays[f'{name}_indptr'] = m.indptr
+            arrays[f'{name}_shape'] = np.array(m.shape)
+        return arrays
+
+    def _load_precomputation(self, arrays: Dict[str, npt.NDArray]) -> None:
+        """ Inverse of _dump_precomputation(). """
+        self.e_v_idxs = arrays['e_v_idxs']
+        self.edge_vectors = arrays['edge_vectors']
+        self.pin_mask = arrays['pin_mask']
+        self.pins_v_idxs = arrays['pins_v_idxs']
+        self.pins_bc = arrays['pins_bc']
+
+        self.edge_num = len(self.e_v_idxs)
+        self.vert_num = len(self.vertices)
+        self.pin_num = int(self.pin_mask.sum())
+
+        for name in self._CACHED_MATRICES:
+            m = sp.csr_matrix((arrays[f'{name}_data'], arrays[f'{name}_indices'], arrays[f'{name}_indptr']),
+                              shape=tuple(arrays[f'{name}_shape']))
+            setattr(self, name, m)
+
+    def update_pins(self, pins_xy: npt.NDArray[np.float32], max_update_rank: int = 64) -> None:
+        """
+        Re-binds the pins to new initial xy positions. Pins can be moved, added or removed: afterwards,
+        solve() expects pins in the same order as pins_xy. As with __init__, pins outside the mesh are skipped.
+
+        Only the pin rows of the system matrices depend upon the pins. So rather than refactorizing, the normal matrices'
+        factorizations are corrected using the Woodbury identity, with one rank-one term per added or removed pin row.
+        Pins whose binding did not change cost nothing. If the correction would exceed max_update_rank (in pins, relative to
+        the last full factorization), or is numerically unstable, the normal matrices are refactorized instead.
+
+        pins_xy: ndarray [N, 2] specifying the new initial xy positions of N control points
+        """
+        self.pins_v_idxs, self.pins_bc, self.pin_mask = self._xy_to_barycentric_coords(pins_xy, self.vertices, self.tris)
+        self.pin_num = len(self.pins_v_idxs)
+        self._result_cache.clear()  # cached results are for the old pins
+
+        A1_pins, A2_pins = self._get_pin_rows(self.pins_v_idxs, self.pins_bc)
+        self.tA1 = sp.hstack([self.tA1[:, :2 * self.edge_num], A1_pins.transpose()]).tocsr()
+        self.tA2 = sp.hstack([self.tA2[:, :self.edge_num], A2_pins.transpose()]).tocsr()
+
+        # find the pins that differ from those of the last full factorization
+        added_idxs, removed_idxs = self._diff_pin_bindings(self._factorized_pins_v_idxs, self._factorized_pins_bc,
+                                                           self.pins_v_idxs, self.pins_bc)
+
+        A1_added, A2_added = self._get_pin_rows(self.pins_v_idxs[added_idxs], self.pins_bc[added_idxs])
+        A1_removed, A2_removed = self._get_pin_rows(self._factorized_pins_v_idxs[removed_idxs], self._factorized_pins_bc[removed_idxs])
+
+        # normal matrices after the change are those of the last factorization, plus the outer products of added pin rows,
+        # minus the outer products of removed pin rows: tAxA' = tAxA + U diag(c) U^T
+        U1: csr_matrix = sp.vstack([A1_added, A1_removed]).transpose().tocsr()
+        U2: csr_matrix = sp.vstack([A2_added, A2_removed]).transpose().tocsr()
+        c1 = np.concatenate([np.ones(A1_added.shape[0]), -np.ones(A1_removed.shape[0])])
+        c2 = np.concatenate([np.ones(A2_added.shape[0]), -np.ones(A2_removed.shape[0])])
+        self.tA1xA1 = (self._factorized_tA1xA1 + U1 @ sp.diags(c1) @ U1.transpose()).tocsr()
+        self.tA2xA2 = (self._factorized_tA2xA2 + U2 @ sp.diags(c2) @ U2.transpose()).tocsr()
+
+        if len(added_idxs) + len(removed_idxs) <= max_update_rank:
+            try:
+                self.tA1xA1_lu = WoodburyLU(self._factorized_tA1xA1_lu, U1, c1)
+                self.tA2xA2_lu = WoodburyLU(self._factorized_tA2xA2_lu, U2, c2)
+                return
+            except np.linalg.LinAlgError as e:
+                logging.info(f'Low-rank ARAP pin update is unstable, refactorizing instead: {e}')
+
+        self.tA1xA1, self._factorized_tA1xA1_lu = self._factorize(self.tA1xA1, 'tA1xA1')
+        self.tA2xA2, self._factorized_tA2xA2_lu = self._factorize(self.tA2xA2, 'tA2xA2')
+        self.tA1xA1_lu, self.tA2xA2_lu = self._factorized_tA1xA1_lu, self._factorized_tA2xA2_lu
+        self._factorized_tA1xA1, self._factorized_tA2xA2 = self.tA1xA1, self.tA2xA2
+        self._factorized_pins_v_idxs, self._factorized_pins_bc = self.pins_v_idxs, self.pins_bc
+
+    def _get_pin_rows(self, pins_v_idxs: npt.NDArray[np.int64], pins_bc: npt.NDArray[np.float64]) -> Tuple[csr_matrix, csr_matrix]:
+        """
+        Returns the rows of A1 [2P, 2V] (x and y row for each pin) and A2 [P, V] (one row per pin) constraining pins to their bound locations.
+        pins_v_idxs: ndarray [P, 3] IDs of the vertices of the triangle containing each pin
+        pins_bc: ndarray [P, 3] barycentric coordinates of each pin wrt those vertices
+        """
+        pin_num = len(pins_v_idxs)
+        pin_rows = np.repeat(np.arange(pin_num), 3)
+        vals = self.w * np.asarray(pins_bc, dtype=np.float64).reshape(-1)
+
+        A1_pins = self._triplets_to_csr([2*pin_rows, 2*pin_rows + 1],
+                                        [2*pins_v_idxs.reshape(-1), 2*pins_v_idxs.reshape(-1) + 1],
+                                        [vals, vals], (2 * pin_num, 2 * self.vert_num))
+        A2_pins = self._triplets_to_csr([pin_rows], [pins_v_idxs.reshape(-1)], [vals], (pin_num, self.vert_num))
+        return A1_pins, A2_pins
+
+    @staticmethod
+    def _diff_pin_bindings(old_v_idxs: npt.NDArray[np.int64], old_bc: npt.NDArray[np.float64],
+                           new_v_idxs: npt.NDArray[np.int64], new_bc: npt.NDArray[np.float64]
+                           ) -> Tuple[npt.NDArray[np.int64], npt.NDArray[np.int64]]:
+        """
+        Pins contribute to the normal matrices independently of their order, so matches old and new pins by binding.
+        Returns indices of new pins without an identical old pin, and of old pins without an identical new pin.
+        """
+        unmatched_old: Dict[bytes, List[int]] = {}
+        for idx in range(len(old_v_idxs)):
+            unmatched_old.setdefault(old_v_idxs[idx].tobytes() + old_bc[idx].tobytes(), []).append(idx)
+
+        added_idxs: List[int] = []
+        for idx in range(len(new_v_idxs)):
+            matches = unmatched_old.get(new_v_idxs[idx].tobytes() + new_bc[idx].tobytes())
+            if matches:
+                matches.pop()
+            else:
+                added_idxs.append(idx)
+
+        removed_idxs: List[int] = sorted(idx for idxs in unmatched_old.values() for idx in idxs)
+
+        return np.array(added_idxs, dtype=np.int64), np.array(removed_idxs, dtype=np.int64)
+
+    def set_result_cache(self, max_entries: int, quantization: float = 1e-4) -> None:
+        """
+        Enables an LRU cache of solve() results holding up to max_entries vertex arrays (0 disables it).
+        Results are keyed by pin positions rounded to multiples of quantization, so a pose within quantization
+        of a cached one returns the cached vertices without solving. Useful for looping or repeated motions.
+        Hit and miss counts are kept in result_cache_hits and result_cache_misses.
+        """
+        if max_entries < 0 or quantization <= 0.0:
+            msg = f'Invalid ARAP result cache settings: max_entries={max_entries}, quantization={quantization}'
+            logging.critical(msg)
+            assert False, msg
+
+        self.result_cache_max_entries: int = max_entries
+        self.result_cache_quantization: float = quantization
+        self.result_cache_hits: int = 0
+        self.result_cache_misses: int = 0
+        self._result_cache: OrderedDict[bytes, npt.NDArray[np.float64]] = OrderedDict()
 
     def solve(self, pins_xy_: npt.NDArray[np.float32]) -> npt.NDArray[np.float64]:
         """
@@ -173,7 +376,7 @@ class ARAP():
         pins *must* be in the same order they were passed in during initialization
 
         pins_xy: ndarray [N, 2] with new pin xy positions
-        return: ndarray [N, 2], the updated xy locations of each vertex in the mesh
+        return: ndarray [N, 2], the updated xy locations of each vertex in the mesh. Read-only if the result cache is enabled
         """
 
         # remove any pins that were orgininally outside the mesh
@@ -181,48 +384,167 @@ class ARAP():
 
         assert len(pins_xy) == self.pin_num
 
-        self.b1: npt.NDArray[np.float64] = np.hstack([np.zeros([2 * self.edge_num], dtype=np.float64), self.w * pins_xy.reshape([-1, ])])
-        v1: npt.NDArray[np.float64] = spla.spsolve(self.tA1xA1, self.tA1 @ self.b1.T)
-
-        T1: npt.NDArray[np.float64] = self.G @ v1
-        b2_top = np.empty([self.edge_num, 2], dtype=np.float64)
-        for idx, e0 in enumerate(self.edge_vectors):
-            c: np.float64 = T1[2*idx]
-            s: np.float64 = T1[2*idx + 1]
-            scale = 1.0 / np.sqrt(c * c + s * s)
-            c *= scale
-            s *= scale
-            T2 = np.asarray(((c, s), (-s, c)))  # create rotation matrix
-            e1 = np.dot(T2, e0)                 # and rotate old vector to get new
-            b2_top[idx] = e1
-        b2 = np.vstack([b2_top, self.w * pins_xy])
-        b2x = b2[:, 0]
-        b2y = b2[:, 1]
-
-        v2x: npt.NDArray[np.float64] = spla.spsolve(self.tA2xA2, self.tA2 @ b2x)
-        v2y: npt.NDArray[np.float64] = spla.spsolve(self.tA2xA2, self.tA2 @ b2y)
-
-        return np.vstack((v2x, v2y)).T
+        if self.result_cache_max_entries == 0:
+            return self._solve(pins_xy)
+
+        key: bytes = np.round(pins_xy / self.result_cache_quantization).astype(np.int64).tobytes()
+        vertices: Optional[npt.NDArray[np.float64]] = self._result_cache.get(key)
+        if vertices is not None:
+            self._result_cache.move_to_end(key)
+            self.result_cache_hits += 1
+            return vertices
+
+        self.result_cache_misses += 1
+        vertices = self._solve(pins_xy)
+        vertices.setflags(write=False)  # shared by every later hit, so must not be modified
+        self._result_cache[key] = vertices
+        if len(self._result_cache) > self.result_cache_max_entries:
+            self._result_cache.popitem(last=False)
+        return vertices
+
+    def _solve(self, pins_xy: npt.NDArray[np.float32]) -> npt.NDArray[np.float64]:
+        """ Solves for a single frame. pins_xy: ndarray [P, 2] of pins inside the mesh """
+        return self._solve_frames(np.expand_dims(pins_xy, axis=0))[0]
+
+    def solve_batch(self, pins_xy_: npt.NDArray[np.float32], frames_per_pass: int = 256,
+                    out: Optional[npt.NDArray] = None) -> npt.NDArray:
+        """
+        Same as solve(), but for many frames at once. Because the system matrices never change, all frames
+        are solved together as a multi-column right-hand side, frames_per_pass columns at a time.
+
+        pins_xy: ndarray [F, N, 2] with new pin xy positions for each of F frames
+        out: optional ndarray [F, V, 2] into which each pass's results are written, in out's dtype (e.g. float32).
+            Only one pass's results are ever held at float64 precision
+        return: ndarray [F, V, 2], the updated xy locations of each vertex in the mesh, for each frame. out, if specified
+        """
+
+        # remove any pins that were orgininally outside the mesh
+        pins_xy: npt.NDArray[np.float32] = pins_xy_[:, self.pin_mask]  # pyright: ignore[reportGeneralTypeIssues]
+
+        assert pins_xy.shape[1] == self.pin_num
+
+        if out is None:
+            out = np.empty([len(pins_xy), self.vert_num, 2], dtype=np.float64)
+        elif out.shape != (len(pins_xy), self.vert_num, 2):
+            msg = f'solve_batch out has shape {out.shape}, expected {(len(pins_xy), self.vert_num, 2)}'
+            logging.critical(msg)
+            assert False, msg
+
+        for start_idx in range(0, len(pins_xy), frames_per_pass):
+            out[start_idx:start_idx+frames_per_pass] = self._solve_frames(pins_xy[start_idx:start_idx+frames_per_pass])
+
+        return out
+
+    def _solve_frames(self, pins_xy: npt.NDArray[np.float32]) -> npt.NDArray[np.float64]:
+        """
+        Performs both solve steps for F frames at once, with each frame as one column of the right-hand sides.
+        pins_xy: ndarray [F, P, 2] of pin positions, with pins outside the mesh already removed
+        return: ndarray [F, V, 2] of vertex positions
+        """
+        frame_num: int = len(pins_xy)
+        pins_xy_t: npt.NDArray[np.float64] = np.asarray(pins_xy, dtype=np.float64).transpose(1, 2, 0)  # [P, 2, F]
+
+        # step 1: rotation and scaling are both free
+        b1 = np.zeros([2 * (self.edge_num + self.pin_num), frame_num], dtype=np.float64)
+        b1[2 * self.edge_num:] = self.w * pins_xy_t.reshape([-1, frame_num])
+        v1: npt.NDArray[np.float64] = self.tA1xA1_lu.solve(self.tA1 @ b1)  # [2V, F]
+
+        T1: npt.NDArray[np.float64] = self.G @ v1  # [2E, F]
+
+        # step 2: rotate original edges by step 1's rotations, then solve for x and y together
+        b2_top: npt.NDArray[np.float64] = self._rotate_edge_vectors(T1)
+        b2 = np.concatenate([b2_top, self.w * pins_xy_t]).reshape([self.edge_num + self.pin_num, 2 * frame_num])
+        v2: npt.NDArray[np.float64] = self.tA2xA2_lu.solve(self.tA2 @ b2)  # [V, 2F]
+
+        return v2.reshape([self.vert_num, 2, frame_num]).transpose(2, 0, 1)
+
+    def _rotate_edge_vectors(self, T1: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+        """
+        Normalizes each edge's (c, s) pair within T1 and uses it to rotate that edge's original vector. All edges and frames at once.
+        T1: ndarray [2E, F], the result of applying G to the step 1 solution of F frames
+        return: ndarray [E, 2, F] of rotated edge vectors
+        """
+        T1 = T1.reshape([self.edge_num, 2, -1])
+        scale = 1.0 / np.sqrt(T1[:, 0] * T1[:, 0] + T1[:, 1] * T1[:, 1])
+        c: npt.NDArray[np.float64] = T1[:, 0] * scale
+        s: npt.NDArray[np.float64] = T1[:, 1] * scale
+        e0x, e0y = self.edge_vectors[:, 0:1], self.edge_vectors[:, 1:2]
+        return np.stack([c * e0x + s * e0y, -s * e0x + c * e0y], axis=1)
+
+    @staticmethod
+    def _factorize(M: csr_matrix, name: str, max_attempts: int = 8) -> Tuple[csr_matrix, spla.SuperLU]:
+        """
+        LU factorizes sparse matrix M. If M is singular, adds a Tikhonov term (reg * I), growing reg by 10x on each retry.
+        name is only used for logging.
+        Returns the (possibly regularized) matrix and its factorization.
+        """
+        reg: float = 1e-8
+        for _ in range(max_attempts):
+            try:
+                return M, spla.splu(M.tocsc().astype(np.float64))
+            except RuntimeError:  # raised by SuperLU when M is exactly singular
+                logging.info(f'{name} is singular. regularizing with {reg} * I...')
+                M = (M + reg * sp.identity(M.shape[0], dtype=M.dtype, format='csr')).tocsr()
+                reg *= 10
+
+        msg = f'Could not factorize {name}, even after regularization'
+        logging.critical(msg)
+        assert False, msg
+
+    @staticmethod
+    def _triplets_to_csr(rows: List[npt.NDArray[np.int64]],
+                         cols: List[npt.NDArray[np.int64]],
+                         vals: List[npt.NDArray[np.float64]],
+                         shape: Tuple[int, int]
+                         ) -> csr_matrix:
+        """ Builds a CSR matrix from lists of row, column, and value arrays. Duplicate entries are summed. """
+        if not rows:
+            return sp.csr_matrix(shape, dtype=np.float64)
+        return sp.coo_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=shape).tocsr()
 
     def _xy_to_barycentric_coords(self,
                                   points: npt.NDArray[np.float32],
                                   vertices: npt.NDArray[np.float32],
-                                  triangles: List[npt.NDArray[np.int32]]
-                                  ) -> Tuple[List[Tuple[Tuple[np.int32, np.float32], Tuple[np.int32, np.float32], Tuple[np.int32, np.float32]]],
-                                             npt.NDArray[np.bool8]]:
+                                  tris: npt.NDArray[np.int64]
+                                  ) -> Tuple[npt.NDArray[np.int64], npt.NDArray[np.float64], npt.NDArray[np.bool8]]:
         """
         Given and array containing xy locations and the vertices & triangles making up a mesh,
         find the triangle that each points in within and return it's representation using barycentric coordinates.
         points: ndarray [N,2] of point xy coords
         vertices: ndarray of vertex locations, row position is index id
-        triangles: ndarraywith ordered vertex ids of vertices that make up each mesh triangle
+        tris: ndarray [T, 3] with ordered vertex ids of vertices that make up each mesh triangle
 
         Is point inside triangle? : https://mathworld.wolfram.com/TriangleInterior.html
 
-        Returns a list of barycentric coords for points inside the mesh,
-        and a list of True/False values indicating whether a given pin was inside the mesh or not.
+        Rather than testing each point against every triangle, triangles are binned into a uniform grid by their bounding boxes,
+        and each point is only tested against the triangles overlapping its grid cell.
+        If a point is inside several triangles (or on several triangles' edges), the one with the lowest ID is used.
+
+        Returns vertex ids [M, 3] of the triangle containing each point inside the mesh, the point's barycentric coordinates [M, 3]
+        wrt those vertices, and a list of N True/False values indicating whether a given pin was inside the mesh or not.
         Needed for removing pins during subsequent solve steps.
+        """
+        points = np.asarray(points)
+        p_t_idx = self._locate_triangles(points, vertices, tris)
+        pin_mask = p_t_idx < len(tris)
+
+        # point is outside mesh. Log a warning and continue
+        for p_xy in points[~pin_mask]:
+            msg = f'point {p_xy[None]} not inside or on edge of any triangle in mesh. Skipping it'
+            print(msg)
+            logging.warning(msg)
+
+        vertex_ids = tris[p_t_idx[pin_mask]]  # get ids of verts in triangle
+        a_xy, b_xy, c_xy = vertices[vertex_ids].transpose(1, 0, 2)  # get xy coords of verts
+        uvw = self._get_barycentric_coords(points[pin_mask], a_xy, b_xy, c_xy)
 
+        return vertex_ids, uvw.astype(np.float64), pin_mask
+
+    @staticmethod
+    def _locate_triangles(points: npt.NDArray[np.float32], vertices: npt.NDArray[np.float32], tris: npt.NDArray[np.int64]) -> npt.NDArray[np.int64]:
+        """
+        Returns ndarray [N] with the ID of the triangle containing each point, or len(tris) if the point is outside the mesh.
+        See _xy_to_barycentric_coords() for details.
         """
         def det(u: npt.NDArray[np.float32], v: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
             """ helper function returns determinents of two [N,2] arrays"""
@@ -230,76 +552,248 @@ class ARAP():
             vx, vy = v[:, 0], v[:, 1]
             return ux*vy - uy*vx
 
-        tv_locs: npt.NDArray[np.float32] = np.asarray([vertices[t].flatten() for t in triangles])  # triangle->vertex locations, [T x 6] array
-
-        v0 = tv_locs[:, :2]
-        v1 = np.subtract(tv_locs[:, 2:4], v0)
-        v2 = np.subtract(tv_locs[:, 4: ], v0)
-
-        b_coords: List[Tuple[Tuple[np.int32, np.float32], Tuple[np.int32, np.float32], Tuple[np.int32, np.float32]]] = []
-        pin_mask: List[bool] = []
-
-        for p_xy in points:
-
-            p_xy = np.expand_dims(p_xy, axis=0)
-            a =  (det(p_xy, v2) - det(v0, v2)) / det(v1, v2)
-            b = -(det(p_xy, v1) - det(v0, v1)) / det(v1, v2)
-
-            # find the indices of triangle containing
-            in_triangle = np.bitwise_and(np.bitwise_and(a > 0, b > 0), a + b < 1)
-            containing_t_idxs = np.argwhere(in_triangle)
-
-            # if length is zero, check if on triangle(s) perimeters
-            if not len(containing_t_idxs):
-                on_triangle_perimeter = np.bitwise_and(np.bitwise_and(a >= 0, b >= 0), a + b <= 1)
-                containing_t_idxs = np.argwhere(on_triangle_perimeter)
-
-            # point is outside mesh. Log a warning and continue
-            if not len(containing_t_idxs):
-                msg = f'point {p_xy} not inside or on edge of any triangle in mesh. Skipping it'
-                print(msg)
-                logging.warning(msg)
-                pin_mask.append(False)
-                continue
-
-            # grab the id of first triangle the point is in or on
-            t_idx = int(containing_t_idxs[0])
-
-            vertex_ids = triangles[t_idx]                               # get ids of verts in triangle
-            a_xy, b_xy, c_xy = vertices[vertex_ids]                     # get xy coords of verts
-            uvw = self._get_barycentric_coords(p_xy, a_xy, b_xy, c_xy)  # get barycentric coords
-            b_coords.append(list(zip(vertex_ids, uvw)))                 # append to our list  # pyright: ignore[reportGeneralTypeIssues]
-            pin_mask.append(True)
-
-        return (b_coords, np.array(pin_mask, dtype=np.bool8))
-
-    def _get_barycentric_coords(self,
-                                p: npt.NDArray[np.float32],
+        points = np.asarray(points)
+        tv_locs: npt.NDArray[np.float32] = vertices[tris]  # triangle->vertex locations, [T, 3, 2] array
+
+        # bin triangles into a grid with roughly one triangle per cell
+        grid_min, grid_max = vertices.min(axis=0), vertices.max(axis=0)
+        grid_res = max(1, int(np.sqrt(len(tris))))
+        cell_size = np.maximum((grid_max - grid_min) / grid_res, np.finfo(np.float32).eps)
+
+        def to_cell(xy: npt.NDArray[np.float32]) -> npt.NDArray[np.int64]:
+            return np.clip(np.floor((xy - grid_min) / cell_size).astype(np.int64), 0, grid_res - 1)
+
+        t_cell_min, t_cell_max = to_cell(tv_locs.min(axis=1)), to_cell(tv_locs.max(axis=1))  # [T, 2] cell ranges covered by bounding boxes
+        t_cell_dims = t_cell_max - t_cell_min + 1
+        t_cell_count = t_cell_dims[:, 0] * t_cell_dims[:, 1]
+
+        cell_t_idxs = np.repeat(np.arange(len(tris)), t_cell_count)  # one entry per (triangle, overlapped cell) pair
+        offset = np.arange(len(cell_t_idxs)) - np.repeat(np.cumsum(t_cell_count) - t_cell_count, t_cell_count)
+        cell_xy = t_cell_min[cell_t_idxs] + np.stack([offset % t_cell_dims[cell_t_idxs, 0], offset // t_cell_dims[cell_t_idxs, 0]], axis=-1)
+        cell_ids = cell_xy[:, 1] * grid_res + cell_xy[:, 0]
+
+        order = np.argsort(cell_ids, kind='stable')  # sorted by cell, then by triangle ID
+        cell_t_idxs = cell_t_idxs[order]
+        cell_indptr = np.concatenate([[0], np.cumsum(np.bincount(cell_ids, minlength=grid_res * grid_res))])
+
+        # gather the candidate triangles for each point. Points outside the grid have none
+        in_grid = np.all((points >= grid_min) & (points <= grid_max), axis=1)
+        p_cell_xy = to_cell(points)
+        p_cell_ids = p_cell_xy[:, 1] * grid_res + p_cell_xy[:, 0]
+        p_cand_count = np.where(in_grid, cell_indptr[p_cell_ids + 1] - cell_indptr[p_cell_ids], 0)
+
+        cand_p_idxs = np.repeat(np.arange(len(points)), p_cand_count)
+        cand_offset = np.arange(len(cand_p_idxs)) - np.repeat(np.cumsum(p_cand_count) - p_cand_count, p_cand_count)
+        cand_t_idxs = cell_t_idxs[cell_indptr[p_cell_ids[cand_p_idxs]] + cand_offset]
+
+        # test each point against its candidate triangles
+        p_xy = points[cand_p_idxs]
+        v0 = tv_locs[cand_t_idxs, 0]
+        v1 = np.subtract(tv_locs[cand_t_idxs, 1], v0)
+        v2 = np.subtract(tv_locs[cand_t_idxs, 2], v0)
+        a = (det(p_xy, v2) - det(v0, v2)) / det(v1, v2)
+        b = -(det(p_xy, v1) - det(v0, v1)) / det(v1, v2)
+
+        # find the lowest ID triangle containing each point, falling back to triangles with the point on their perimeter
+        in_triangle = np.bitwise_and(np.bitwise_and(a > 0, b > 0), a + b < 1)
+        on_triangle_perimeter = np.bitwise_and(np.bitwise_and(a >= 0, b >= 0), a + b <= 1)
+        no_t = len(tris)
+        p_in_t_idx = np.full(len(points), no_t)
+        np.minimum.at(p_in_t_idx, cand_p_idxs[in_triangle], cand_t_idxs[in_triangle])
+        p_on_t_idx = np.full(len(points), no_t)
+        np.minimum.at(p_on_t_idx, cand_p_idxs[on_triangle_perimeter], cand_t_idxs[on_triangle_perimeter])
+        return np.where(p_in_t_idx < no_t, p_in_t_idx, p_on_t_idx)
+
+    @staticmethod
+    def _get_barycentric_coords(p: npt.NDArray[np.float32],
                                 a: npt.NDArray[np.float32],
                                 b: npt.NDArray[np.float32],
                                 c: npt.NDArray[np.float32]
                                 ) -> npt.NDArray[np.float32]:
         """
         As described in Christer Ericson's Real-Time Collision Detection.
-        p: the input point
-        a, b, c: the vertices of the triangle
+        p: ndarray [N, 2], the input points
+        a, b, c: ndarrays [N, 2], the vertices of the triangles
 
-        Returns ndarray [u, v, w], the barycentric coordinates of p wrt vertices a, b, c
+        Returns ndarray [N, 3] [u, v, w], the barycentric coordinates of each p wrt vertices a, b, c
         """
         v0: npt.NDArray[np.float32] = np.subtract(b, a)
         v1: npt.NDArray[np.float32] = np.subtract(c, a)
         v2: npt.NDArray[np.float32] = np.subtract(p, a)
-        d00: np.float32 = np.dot(v0, v0)
-        d01: np.float32 = np.dot(v0, v1)
-        d11: np.float32 = np.dot(v1, v1)
-        d20: np.float32 = np.dot(v2, v0)
-        d21: np.float32 = np.dot(v2, v1)
+        d00: npt.NDArray[np.float32] = np.einsum('ij,ij->i', v0, v0)
+        d01: npt.NDArray[np.float32] = np.einsum('ij,ij->i', v0, v1)
+        d11: npt.NDArray[np.float32] = np.einsum('ij,ij->i', v1, v1)
+        d20: npt.NDArray[np.float32] = np.einsum('ij,ij->i', v2, v0)
+        d21: npt.NDArray[np.float32] = np.einsum('ij,ij->i', v2, v1)
         denom = d00 * d11 - d01 * d01
-        v: npt.NDArray[np.float32] = (d11 * d20 - d01 * d21) / denom  # pyright: ignore[reportGeneralTypeIssues]
-        w: npt.NDArray[np.float32] = (d00 * d21 - d01 * d20) / denom  # pyright: ignore[reportGeneralTypeIssues]
+        v: npt.NDArray[np.float32] = (d11 * d20 - d01 * d21) / denom
+        w: npt.NDArray[np.float32] = (d00 * d21 - d01 * d20) / denom
         u: npt.NDArray[np.float32] = 1.0 - v - w
 
-        return np.array([u, v, w]).squeeze()
+        return np.stack([u, v, w], axis=-1)
+
+
+class BlockDiagonalARAP():
+    """
+    Solves the systems of several independent ARAP instances (e.g. one per character in a scene) together.
+    Their matrices are stacked into block-diagonal systems, held by a single combined ARAP instance, so each solve step
+    is a single factorized back-substitution for all instances, rather than one per instance.
+
+    Pins and vertices are concatenated in the order the instances were passed in. solve_each() splits the combined
+    instance's results per instance. Changes made to the instances afterwards (e.g. via update_pins()) are not reflected.
+    """
+
+    def __init__(self, araps: List[ARAP]):
+        """ araps: the instances to combine. All must use the same pin weight w. """
+        if len(araps) == 0 or len({arap.w for arap in araps}) != 1:
+            msg = 'BlockDiagonalARAP requires at least one ARAP instance, all using the same pin weight'
+            logging.critical(msg)
+            assert False, msg
+
+        self.araps: List[ARAP] = araps
+
+        # offsets of each instance's vertices within the concatenated vertex array
+        self._vert_offsets: npt.NDArray[np.int64] = np.cumsum([0] + [arap.vert_num for arap in araps])
+
+        # the combined system. Its solve() and solve_batch() take the instances' pins concatenated, and return their vertices concatenated
+        self.arap: ARAP = self._stack(araps, self._vert_offsets[:-1])
+
+    @staticmethod
+    def _stack(araps: List[ARAP], vert_offsets: npt.NDArray[np.int64]) -> ARAP:
+        """ Returns an ARAP instance whose system matrices are the block-diagonal stacks of araps' matrices. """
+        arap: ARAP = ARAP.__new__(ARAP)
+        arap.w = araps[0].w
+
+        arap.vertices = np.concatenate([each.vertices for each in araps])
+        arap.tris = np.concatenate([each.tris + offset for each, offset in zip(araps, vert_offsets)])
+        arap.e_v_idxs = np.concatenate([each.e_v_idxs + offset for each, offset in zip(araps, vert_offsets)])
+        arap.edge_vectors = np.concatenate([each.edge_vectors for each in araps])
+        arap.pins_v_idxs = np.concatenate([each.pins_v_idxs + offset for each, offset in zip(araps, vert_offsets)])
+        arap.pins_bc = np.concatenate([each.pins_bc for each in araps])
+        arap.pin_mask = np.concatenate([each.pin_mask for each in araps])
+
+        arap.edge_num = sum(each.edge_num for each in araps)
+        arap.vert_num = sum(each.vert_num for each in araps)
+        arap.pin_num = sum(each.pin_num for each in araps)
+
+        # solves expect all edge rows before all pin rows, so edge and pin columns of tA1 and tA2 are grouped separately
+        arap.tA1 = sp.hstack([sp.block_diag([each.tA1[:, :2 * each.edge_num] for each in araps]),
+                              sp.block_diag([each.tA1[:, 2 * each.edge_num:] for each in araps])]).tocsr()
+        arap.tA2 = sp.hstack([sp.block_diag([each.tA2[:, :each.edge_num] for each in araps]),
+                              sp.block_diag([each.tA2[:, each.edge_num:] for each in araps])]).tocsr()
+        arap.G = sp.block_diag([each.G for each in araps], format='csr')
+
+        # instances' normal matrices were already regularized if needed, so the stacked matrices factorize directly
+        arap.tA1xA1 = sp.block_diag([each.tA1xA1 for each in araps], format='csr')
+        arap.tA2xA2 = sp.block_diag([each.tA2xA2 for each in araps], format='csr')
+
+        arap._init_solver()
+        return arap
+
+    def set_result_cache(self, max_entries: int, quantization: float = 1e-4) -> None:
+        """ Enables an LRU cache of the combined instance's results. See ARAP.set_result_cache() """
+        self.arap.set_result_cache(max_entries, quantization)
+
+    def solve_each(self, pins_xy: List[npt.NDArray[np.float32]]) -> List[npt.NDArray[np.float64]]:
+        """
+        Solves all instances at once.
+        pins_xy: list with one ndarray [N_i, 2] of new pin xy positions per instance, as would be passed to its own solve()
+        return: list with one ndarray [V_i, 2] of vertex positions per instance
+        """
+        vertices = self.arap.solve(np.concatenate(pins_xy))
+        return [vertices[start:end] for start, end in zip(self._vert_offsets[:-1], self._vert_offsets[1:])]
+
+
+class WoodburyLU():
+    """
+    Solves (M + U diag(c) U^T) x = b, given an LU factorization of M, using the Woodbury identity:
+    x = y - Z (diag(1/c) + U^T Z)^-1 U^T y, where y = M^-1 b and Z = M^-1 U.
+    Has the same solve() interface as spla.SuperLU, so it can be used in its place.
+    """
+
+    def __init__(self, M_lu: spla.SuperLU, U: csr_matrix, c: npt.NDArray[np.float64], max_condition_number: float = 1e12):
+        """
+        M_lu: factorization of the [N, N] matrix M
+        U: sparse [N, K] matrix of update vectors
+        c: ndarray [K], weight of each update vector. Must be nonzero
+        max_condition_number: raises np.linalg.LinAlgError if the [K, K] capacitance matrix is more poorly conditioned than this
+        """
+        self.M_lu: spla.SuperLU = M_lu
+        self.U: csr_matrix = U
+
+        self.Z: npt.NDArray[np.float64] = M_lu.solve(U.toarray()) if U.shape[1] else np.zeros(U.shape)
+        capacitance = np.diag(1.0 / c) + U.transpose() @ self.Z
+        if U.shape[1] and np.linalg.cond(capacitance) > max_condition_number:
+            raise np.linalg.LinAlgError('capacitance matrix is near singular')
+        self.capacitance_lu = scipy.linalg.lu_factor(capacitance) if U.shape[1] else None
+
+    def solve(self, b: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+        """ b: ndarray [N] or [N, F] """
+        y: npt.NDArray[np.float64] = self.M_lu.solve(b)
+        if self.capacitance_lu is None:
+            return y
+        return y - self.Z @ scipy.linalg.lu_solve(self.capacitance_lu, self.U.transpose() @ y)
+
+
+def get_barycentric_interpolation_matrix(points: npt.NDArray[np.float32],
+                                         vertices: npt.NDArray[np.float32],
+                                         triangles: List[npt.NDArray[np.int32]],
+                                         points_triangles: Optional[List[npt.NDArray[np.int32]]] = None,
+                                         max_extrapolation: float = 2.0
+                                         ) -> csr_matrix:
+    """
+    Returns sparse matrix B [N, V] such that B @ deformed_vertices gives the positions of points after the mesh is deformed.
+    Each row holds the barycentric coordinates of one point wrt the triangle containing it.
+    Points outside the mesh use the barycentric coordinates (some negative) of a nearby triangle,
+    so they follow that triangle's affine deformation.
+
+    points: ndarray [N, 2] of point xy coords
+    vertices: ndarray [V, 2] of mesh vertex locations
+    triangles: ndarray [T, 3] of vertex ids making up each mesh triangle
+    points_triangles: if the points are themselves the vertices of a mesh, that mesh's triangles.
+        Points outside are then assigned the triangle of the nearest point inside, measured along that mesh's edges,
+        so they follow the part of the mesh they are connected to (rather than, e.g., a nearby but separate limb).
+        Otherwise, and for points not connected to any point inside, the triangle nearest in a straight line is used.
+    max_extrapolation: outside points with a barycentric coordinate below -max_extrapolation are clamped onto their triangle
+    """
+    points = np.asarray(points, dtype=np.float64)
+    tris: npt.NDArray[np.int64] = np.asarray(triangles, dtype=np.int64).reshape([-1, 3])
+    p_t_idx = ARAP._locate_triangles(points, vertices, tris)
+
+    outside = p_t_idx == len(tris)
+    all_outside = np.flatnonzero(outside)
+    if points_triangles is not None and outside.any() and not outside.all():
+        p_tris: npt.NDArray[np.int64] = np.asarray(points_triangles, dtype=np.int64).reshape([-1, 3])
+        p_edges = np.concatenate([p_tris[:, [0, 1]], p_tris[:, [1, 2]], p_tris[:, [2, 0]]])
+        edge_lengths = np.linalg.norm(points[p_edges[:, 0]] - points[p_edges[:, 1]], axis=1)
+        graph = sp.csr_matrix((edge_lengths, (p_edges[:, 0], p_edges[:, 1])), shape=(len(points), len(points)))
+        dist, _, nearest_inside = csgraph.dijkstra(graph, directed=False, indices=np.flatnonzero(~outside),
+                                                   min_only=True, return_predecessors=True)
+        connected = outside & np.isfinite(dist) & (nearest_inside >= 0)
+        p_t_idx[connected] = p_t_idx[nearest_inside[connected]]
+        outside &= ~connected
+
+    # for remaining points outside the mesh, find nearest triangle by distance to its edges
+    outside_idxs = np.flatnonzero(outside)
+    if len(outside_idxs):
+        p = points[outside_idxs, None, None, :]                      # [M, 1, 1, 2]
+        e_start = vertices[tris].astype(np.float64)[None]            # [1, T, 3, 2]
+        e_vec = np.roll(e_start, -1, axis=2) - e_start
+        t = np.clip(np.sum((p - e_start) * e_vec, axis=-1) / np.sum(e_vec * e_vec, axis=-1), 0.0, 1.0)
+        dist = np.linalg.norm(p - (e_start + t[..., None] * e_vec), axis=-1).min(axis=2)  # [M, T]
+        p_t_idx[outside_idxs] = np.argmin(dist, axis=1)
+
+    vertex_ids = tris[p_t_idx]
+    a_xy, b_xy, c_xy = vertices[vertex_ids].astype(np.float64).transpose(1, 0, 2)
+    uvw = ARAP._get_barycentric_coords(points, a_xy, b_xy, c_xy)
+
+    # extrapolating a thin triangle's deformation far beyond it is unstable, so far away points are clamped onto the triangle instead
+    far = all_outside[uvw[all_outside].min(axis=1) < -max_extrapolation]
+    uvw[far] = np.clip(uvw[far], 0.0, None)
+    uvw[far] /= uvw[far].sum(axis=1, keepdims=True)
+
+    return sp.csr_matrix((uvw.reshape(-1), (np.repeat(np.arange(len(points)), 3), vertex_ids.reshape(-1))),
+                         shape=(len(points), len(vertices)))
 
 
 def plot_mesh(vertices, triangles, pins_xy):
@@ -3,9 +3,14 @@
 # LICENSE file in the root directory of this source tree.
 
 from __future__ import annotations  # so we can refer to class Type inside class
+import hashlib
+import io
 import logging
+import re
+import warnings
+from collections import deque
 from pathlib import Path
-from typing import List, Tuple, Optional
+from typing import Deque, Dict, List, Tuple, Optional
 
 import numpy as np
 import numpy.typing as npt
@@ -16,7 +21,7 @@ from animated_drawings.model.quaternions import Quaternions
 from animated_drawings.model.vectors import Vectors
 from animated_drawings.model.joint import Joint
 from animated_drawings.model.time_manager import TimeManager
-from animated_drawings.utils import resolve_ad_filepath
+from animated_drawings.utils import resolve_ad_filepath, read_cache_file, write_cache_file
 
 
 class BVH_Joint(Joint):
@@ -45,6 +50,9 @@ class BVH(Transform, TimeManager):
     and skeletal pos/rot data for each frame
     """
 
+    # bump whenever the contents or meaning of the cached parsed data change, so stale cache files are ignored
+    CACHE_VERSION: int = 1
+
     def __init__(self,
                  name: str,
                  root_joint: BVH_Joint,
@@ -126,45 +134,81 @@ class BVH(Transform, TimeManager):
 
         return Vectors(vectors_cw_perpendicular_to_fwd).average().perpendicular()
 
-    @classmethod
-    def from_file(cls, bvh_fn: str, start_frame_idx: int = 0, end_frame_idx: Optional[int] = None) -> BVH:
-        """ Given a path to a .bvh, constructs and returns BVH object"""
+    def get_all_frames_joint_positions(self) -> npt.NDArray[np.float32]:
+        """
+        Returns ndarray [F, J, 3] of worldspace joint positions for every frame, with joints in get_joint_names() order.
+        Same result as calling apply_frame() and root_joint.get_chain_worldspace_positions() for each frame, but
+        computed for all frames at once. Does not change the skeleton's current pose.
+        """
+        joints, parent_idxs = BVH._get_joints_and_parent_idxs(self.root_joint)
 
-        # search for the BVH file specified
-        bvh_p: Path = resolve_ad_filepath(bvh_fn, 'bvh file')
-        logging.info(f'Using BVH file located at {bvh_p.resolve()}')
+        # the skeleton's own transform (and its ancestors') applies to the root position and every joint's orientation
+        skeleton_m = self.get_world_transform().astype(np.float64)
+        joint_rotations = Quaternions(self.rot_data).to_rotation_matrices()  # [F, J, 3, 3]
 
-        with open(str(bvh_p), 'r') as f:
-            lines = f.read().splitlines()
+        positions = np.empty([self.frame_max_num, len(joints), 3], dtype=np.float64)
+        orientations = np.empty([self.frame_max_num, len(joints), 3, 3], dtype=np.float64)
+        positions[:, 0] = self.pos_data @ skeleton_m[:3, :3].T + skeleton_m[:3, 3]
+        orientations[:, 0] = skeleton_m[:3, :3] @ joint_rotations[:, 0]
+        for idx in range(1, len(joints)):  # parents precede children
+            parent_idx = parent_idxs[idx]
+            positions[:, idx] = positions[:, parent_idx] + orientations[:, parent_idx] @ joints[idx].get_local_position()
+            orientations[:, idx] = orientations[:, parent_idx] @ joint_rotations[:, idx]
 
-        if lines.pop(0) != 'HIERARCHY':
-            msg = f'Malformed BVH in line preceding {lines}'
-            logging.critical(msg)
-            assert False, msg
+        return positions.astype(np.float32)
 
-        # Parse the skeleton
-        root_joint: BVH_Joint = BVH._parse_skeleton(lines)
+    def get_all_frames_skeleton_fwd(self, joint_positions: npt.NDArray[np.float32],
+                                    forward_perp_vector_joint_names: List[Tuple[str, str]]) -> npt.NDArray[np.float32]:
+        """
+        Batched version of get_skeleton_fwd(). Input joint_positions, ndarray [F, J, 3] from get_all_frames_joint_positions().
+        Returns ndarray [F, 3] of the skeleton's forward vector at each frame.
+        """
+        joint_names: List[str] = self.get_joint_names()
 
-        if lines.pop(0) != 'MOTION':
-            msg = f'Malformed BVH in line preceding {lines}'
-            logging.critical(msg)
-            assert False, msg
+        bone_vectors: List[npt.NDArray[np.float32]] = []
+        for (start_joint_name, end_joint_name) in forward_perp_vector_joint_names:
+            for joint_name in (start_joint_name, end_joint_name):
+                if joint_name not in joint_names:
+                    msg = f'Could not find BVH joint with name: {joint_name}'
+                    logging.critical(msg)
+                    assert False, msg
 
-        # Parse motion metadata
-        frame_max_num = int(lines.pop(0).split(':')[-1])
-        frame_time = float(lines.pop(0).split(':')[-1])
+            bone_vector = Vectors(joint_positions[:, joint_names.index(end_joint_name)] - joint_positions[:, joint_names.index(start_joint_name)])
+            bone_vector.norm()
+            bone_vectors.append(bone_vector.vs)
 
-        # Parse motion data
-        frames = [list(map(float, line.strip().split(' '))) for line in lines]
-        if len(frames) != frame_max_num:
-            msg = f'framenum specified ({frame_max_num}) and found ({len(frames)}) do not match'
-            logging.critical(msg)
-            assert False, msg
+        return Vectors(np.mean(bone_vectors, axis=0)).perpendicular().vs.astype(np.float32)
+
+    @classmethod
+    def from_file(cls, bvh_fn: str, start_frame_idx: int = 0, end_frame_idx: Optional[int] = None,
+                  cache_dir: Optional[str] = None, cache_max_mb: float = 1024) -> BVH:
+        """
+        Given a path to a .bvh, constructs and returns BVH object.
+        If cache_dir is specified, the parsed skeleton and motion data (for all frames) are loaded from, or saved to,
+        a cache file keyed by the .bvh's content and modification time. cache_max_mb limits the size of cache_dir.
+        """
+
+        # search for the BVH file specified
+        bvh_p: Path = resolve_ad_filepath(bvh_fn, 'bvh file')
+        logging.info(f'Using BVH file located at {bvh_p.resolve()}')
+
+        cache_file: Optional[Path] = None
+        if cache_dir is not None:
+            cache_file = Path(cache_dir, f'bvh_{BVH._get_cache_key(bvh_p)}.npz')
 
-        # Split logically distinct root position data from joint euler angle rotation data
+        cached: Optional[Dict[str, npt.NDArray]] = None if cache_file is None else read_cache_file(cache_file)
+
+        root_joint: BVH_Joint
+        frame_time: float
+        frames: npt.NDArray[np.float32]
         pos_data: npt.NDArray[np.float32]
         rot_data: npt.NDArray[np.float32]
-        pos_data, rot_data = BVH._process_frame_data(root_joint, frames)
+        if cached is not None:
+            root_joint, frame_time, pos_data, rot_data = BVH._load_parsed_data(cached)
+            frame_max_num = len(pos_data)
+        else:
+            root_joint, frame_time, frames = BVH._parse_file(bvh_p)
+            frame_max_num = len(frames)
 
         # Set end_frame if not passed in
         if not end_frame_idx:
@@ -176,9 +220,19 @@ class BVH(Transform, TimeManager):
             logging.warning(msg)
             end_frame_idx = frame_max_num
 
-        # slice position and rotation data using start and end frame indices
-        pos_data = pos_data[start_frame_idx:end_frame_idx, :]
-        rot_data = rot_data[start_frame_idx:end_frame_idx, :]
+        if cached is None and cache_file is None:
+            # Split logically distinct root position data from joint euler angle rotation data, only for the frames used
+            pos_data, rot_data = BVH._process_frame_data(root_joint, frames[start_frame_idx:end_frame_idx, :])
+        else:
+            if cached is None:
+                # as above, but for all frames, so the cache file serves any start and end frame indices
+                pos_data, rot_data = BVH._process_frame_data(root_joint, frames)
+                assert cache_file is not None
+                write_cache_file(cache_file, BVH._dump_parsed_data(root_joint, frame_time, pos_data, rot_data), cache_max_mb)
+
+            # slice position and rotation data using start and end frame indices
+            pos_data = pos_data[start_frame_idx:end_frame_idx, :]
+            rot_data = rot_data[start_frame_idx:end_frame_idx, :]
 
         # new frame_max_num based is end_frame_idx minus start_frame_idx
         frame_max_num = end_frame_idx - start_frame_idx
@@ -186,76 +240,204 @@ class BVH(Transform, TimeManager):
         return BVH(bvh_p.name, root_joint, frame_max_num, frame_time, pos_data, rot_data)
 
     @classmethod
-    def _parse_skeleton(cls, lines: List[str]) -> BVH_Joint:
+    def _get_cache_key(cls, bvh_p: Path) -> str:
+        """ Returns a hex digest identifying the contents and modification time of the .bvh at bvh_p. """
+        h = hashlib.sha256()
+        h.update(f'{cls.CACHE_VERSION}_{bvh_p.stat().st_mtime_ns}'.encode())
+        with open(str(bvh_p), 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    @classmethod
+    def _dump_parsed_data(cls, root_joint: BVH_Joint, frame_time: float,
+                          pos_data: npt.NDArray[np.float32], rot_data: npt.NDArray[np.float32]) -> Dict[str, npt.NDArray]:
+        """ Returns the skeleton and motion data as a flat dictionary of arrays, suitable for np.savez. """
+        joints, parent_idxs = BVH._get_joints_and_parent_idxs(root_joint)
+
+        return {
+            'joint_names': np.array([str(j.name) for j in joints]),
+            'joint_parents': np.array(parent_idxs, dtype=np.int32),
+            'joint_offsets': np.array([j.get_local_position() for j in joints], dtype=np.float32),
+            'joint_channel_orders': np.array([' '.join(j.channel_order) for j in joints]),
+            'frame_time': np.array(frame_time, dtype=np.float64),
+            'pos_data': np.asarray(pos_data, dtype=np.float32),
+            'rot_data': np.asarray(rot_data, dtype=np.float32),
+        }
+
+    @classmethod
+    def _load_parsed_data(cls, arrays: Dict[str, npt.NDArray]) -> Tuple[BVH_Joint, float, npt.NDArray[np.float32], npt.NDArray[np.float32]]:
+        """ Restores the skeleton, frame time, pos_data and rot_data from a dictionary created by _dump_parsed_data(). """
+        parents: List[int] = arrays['joint_parents'].tolist()
+        children_idxs: List[List[int]] = [[] for _ in parents]
+        for idx, parent_idx in enumerate(parents[1:], start=1):
+            children_idxs[parent_idx].append(idx)
+
+        # construct children before their parents
+        joints: List[Optional[BVH_Joint]] = [None] * len(parents)
+        for idx in reversed(range(len(parents))):
+            joints[idx] = BVH_Joint(name=str(arrays['joint_names'][idx]),
+                                    offset=Vectors(arrays['joint_offsets'][idx]),
+                                    channel_order=str(arrays['joint_channel_orders'][idx]).split(),
+                                    children=[joints[c] for c in children_idxs[idx]])
+
+        root_joint = joints[0]
+        assert root_joint is not None
+        return root_joint, float(arrays['frame_time']), arrays['pos_data'], arrays['rot_data']
+
+    @classmethod
+    def _parse_file(cls, bvh_p: Path) -> Tuple[BVH_Joint, float, npt.NDArray[np.float32]]:
+        """ Parses the .bvh at bvh_p. Returns its skeleton, frame time, and motion data as ndarray [F, channel_num] """
+
+        with open(str(bvh_p), 'r') as f:
+            text = f.read()
+
+        # split the hierarchy from the motion data
+        motion_match = re.search(r'^[ \t]*MOTION[ \t]*$', text, flags=re.MULTILINE)
+        if motion_match is None:
+            msg = f'Malformed BVH, could not find MOTION section: {bvh_p}'
+            logging.critical(msg)
+            assert False, msg
+
+        # tokenize the hierarchy, one list of tokens per non-empty line
+        lines: Deque[List[str]] = deque(line.split() for line in text[:motion_match.start()].splitlines() if line.strip())
+
+        if not lines or lines.popleft() != ['HIERARCHY']:
+            msg = 'Malformed BVH, first line is not HIERARCHY'
+            logging.critical(msg)
+            assert False, msg
+
+        # Parse the skeleton
+        root_joint: BVH_Joint = BVH._parse_skeleton(lines)
+
+        if lines:
+            msg = f'Malformed BVH, expected MOTION but found: {" ".join(lines[0])}'
+            logging.critical(msg)
+            assert False, msg
+
+        # Parse motion metadata
+        motion_lines: List[str] = text[motion_match.end():].lstrip().split('\n', 2)
+        if len(motion_lines) < 2:
+            msg = 'Malformed BVH, missing Frames or Frame Time'
+            logging.critical(msg)
+            assert False, msg
+        frame_max_num = int(motion_lines[0].split(':')[-1])
+        frame_time = float(motion_lines[1].split(':')[-1])
+
+        # Parse motion data in bulk. Values may be separated by any whitespace
+        channel_num: int = len(BVH._get_frame_channel_order(root_joint))
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', UserWarning)  # numpy warns if there are no frames
+                frames: npt.NDArray[np.float32] = np.loadtxt(io.StringIO(motion_lines[2] if len(motion_lines) > 2 else ''), dtype=np.float32, ndmin=2)
+        except ValueError as e:
+            msg = f'Malformed BVH motion data: {e}'
+            logging.critical(msg)
+            assert False, msg
+
+        if len(frames) != frame_max_num:
+            msg = f'framenum specified ({frame_max_num}) and found ({len(frames)}) do not match'
+            logging.critical(msg)
+            assert False, msg
+
+        if frame_max_num and frames.shape[1] != channel_num:
+            msg = f'channel count specified in hierarchy ({channel_num}) and found in motion data ({frames.shape[1]}) do not match'
+            logging.critical(msg)
+            assert False, msg
+
+        return root_joint, frame_time, frames.reshape([frame_max_num, channel_num])
+
+    @classmethod
+    def _parse_skeleton(cls, lines: Deque[List[str]]) -> BVH_Joint:
         """
         Called recursively to parse and construct skeleton from BVH
-        :param lines: partially-processed contents of BVH file. Is modified in-place.
+        :param lines: tokenized lines of the partially-processed hierarchy. Is modified in-place.
         :return: Joint
         """
 
         # Get the joint name
-        if lines[0].strip().startswith('ROOT'):
-            _, joint_name = lines.pop(0).strip().split(' ')
-        elif lines[0].strip().startswith('JOINT'):
-            _, joint_name = lines.pop(0).strip().split(' ')
-        elif lines[0].strip().startswith('End Site'):
-            joint_name = lines.pop(0).strip()
+        if lines and lines[0][0] in ['ROOT', 'JOINT'] and len(lines[0]) == 2:
+            _, joint_name = lines.popleft()
+        elif lines and lines[0][:2] == ['End', 'Site']:
+            joint_name = ' '.join(lines.popleft())
         else:
-            msg = f'Malformed BVH. Line: {lines[0]}'
+            msg = f'Malformed BVH. Line: {" ".join(lines[0]) if lines else "<end of hierarchy>"}'
             logging.critical(msg)
             assert False, msg
 
-        if lines.pop(0).strip() != '{':
-            msg = f'Malformed BVH in line preceding {lines}'
+        if not lines or lines.popleft() != ['{']:
+            msg = f'Malformed BVH, expected {{ after {joint_name}'
             logging.critical(msg)
             assert False, msg
 
         # Get offset
-        if not lines[0].strip().startswith('OFFSET'):
-            msg = f'Malformed BVH in line preceding {lines}'
+        if not lines or lines[0][0] != 'OFFSET':
+            msg = f'Malformed BVH, expected OFFSET for {joint_name}'
             logging.critical(msg)
             assert False, msg
-        _, *xyz = lines.pop(0).strip().split(' ')
+        _, *xyz = lines.popleft()
         offset = Vectors(list(map(float, xyz)))
 
         # Get channels
-        if lines[0].strip().startswith('CHANNELS'):
-            channel_order = lines.pop(0).strip().split(' ')
-            _, channel_num, *channel_order = channel_order
+        if lines and lines[0][0] == 'CHANNELS':
+            _, channel_num, *channel_order = lines.popleft()
         else:
             channel_num, channel_order = 0, []
         if int(channel_num) != len(channel_order):
-            msg = f'Malformed BVH in line preceding {lines}'
+            msg = f'Malformed BVH, CHANNELS count does not match channels listed for {joint_name}'
             logging.critical(msg)
             assert False, msg
 
         # Recurse for children
         children: List[BVH_Joint] = []
-        while lines[0].strip() != '}':
+        while lines and lines[0] != ['}']:
             children.append(BVH._parse_skeleton(lines))
-        lines.pop(0)  # }
+        if not lines:
+            msg = f'Malformed BVH, missing }} for {joint_name}'
+            logging.critical(msg)
+            assert False, msg
+        lines.popleft()  # }
 
         return BVH_Joint(name=joint_name, offset=offset, channel_order=channel_order, children=children)
 
     @classmethod
-    def _process_frame_data(cls, skeleton: BVH_Joint, frames: List[List[float]]) -> Tuple[npt.NDArray[np.float32], npt.NDArray[np.float32]]:
-        """ Given skeleton and frame data, return root position data and joint quaternion data, separately"""
+    def _get_joints_and_parent_idxs(cls, root_joint: BVH_Joint) -> Tuple[List[BVH_Joint], List[int]]:
+        """ Returns the joints of root_joint's chain in depth-first order, and the index of each one's parent (-1 for root_joint) """
+        joints: List[BVH_Joint] = []
+        parent_idxs: List[int] = []
+
+        def _collect(joint: BVH_Joint, parent_idx: int) -> None:
+            joint_idx = len(joints)
+            joints.append(joint)
+            parent_idxs.append(parent_idx)
+            for c in joint.get_children():
+                if isinstance(c, BVH_Joint):
+                    _collect(c, joint_idx)
+        _collect(root_joint, -1)
+
+        return joints, parent_idxs
+
+    @classmethod
+    def _get_frame_channel_order(cls, joint: BVH_Joint) -> List[str]:
+        """ Returns the names of the channels of joint's chain, in the order they appear in each frame of motion data """
+        channels: List[str] = list(joint.channel_order)
+        for child in joint.get_children():
+            if isinstance(child, BVH_Joint):
+                channels.extend(BVH._get_frame_channel_order(child))
+        return channels
 
-        def _get_frame_channel_order(joint: BVH_Joint, channels=[]):
-            channels.extend(joint.channel_order)
-            for child in [child for child in joint.get_children() if isinstance(child, BVH_Joint)]:
-                _get_frame_channel_order(child, channels)
-            return channels
-        channels = _get_frame_channel_order(skeleton)
+    @classmethod
+    def _process_frame_data(cls, skeleton: BVH_Joint, frames: npt.NDArray[np.float32]) -> Tuple[npt.NDArray[np.float32], npt.NDArray[np.float32]]:
+        """ Given skeleton and frame data [F, channel_num], return root position data and joint quaternion data, separately"""
+
+        channels = BVH._get_frame_channel_order(skeleton)
 
         # create a mask so we retain only joint rotations and root position
         mask = np.array(list(map(lambda x: True if 'rotation' in x else False, channels)))
         mask[:3] = True  # hack to make sure we keep root position
 
-        frames = np.array(frames, dtype=np.float32)[:, mask]
-
         # split root pose data and joint euler angle data
-        pos_data, ea_rots = np.split(np.array(frames, dtype=np.float32), [3], axis=1)
+        pos_data, ea_rots = np.split(frames[:, mask], [3], axis=1)
 
         # quaternion rot data will go here
         rot_data = np.empty([len(frames), skeleton.joint_count(), 4], dtype=np.float32)
@@ -97,6 +97,25 @@ class Quaternions:
                          [r20, r21, r22, 0.0],
                          [0.0, 0.0, 0.0, 1.0]], dtype=np.float32)
 
+    def to_rotation_matrices(self) -> npt.NDArray[np.float64]:
+        """
+        Batched version of to_rotation_matrix().
+        :return: ndarray [..., 3, 3] of rotation matrices, one per quaternion
+        """
+        w, x, y, z = np.moveaxis(self.qs.astype(np.float64), -1, 0)
+
+        ret: npt.NDArray[np.float64] = np.empty([*self.qs.shape[:-1], 3, 3], dtype=np.float64)
+        ret[..., 0, 0] = 1 - 2 * (y*y + z*z)
+        ret[..., 0, 1] = 2 * (x*y - w*z)
+        ret[..., 0, 2] = 2 * (x*z + w*y)
+        ret[..., 1, 0] = 2 * (x*y + w*z)
+        ret[..., 1, 1] = 1 - 2 * (x*x + z*z)
+        ret[..., 1, 2] = 2 * (y*z - w*x)
+        ret[..., 2, 0] = 2 * (x*z - w*y)
+        ret[..., 2, 1] = 2 * (y*z + w*x)
+        ret[..., 2, 2] = 1 - 2 * (x*x + y*y)
+        return ret
+
     @classmethod
     def rotate_between_vectors(cls, v1: Vectors, v2: Vectors) -> Quaternions:
         """ Computes quaternion rotating from v1 to v2.  """
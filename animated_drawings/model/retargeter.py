@@ -6,10 +6,9 @@ import logging
 from animated_drawings.model.bvh import BVH
 import numpy as np
 import numpy.typing as npt
-import math
 from animated_drawings.model.joint import Joint
 from sklearn.decomposition import PCA
-from typing import Tuple, List, Dict
+from typing import Tuple, List, Dict, Optional
 from animated_drawings.model.vectors import Vectors
 from animated_drawings.model.quaternions import Quaternions
 from animated_drawings.config import MotionConfig, RetargetConfig
@@ -27,11 +26,13 @@ class Retargeter():
     bone orientations, joint 'depths', and root offsets for each frame.
     """
 
-    def __init__(self, motion_cfg: MotionConfig, retarget_cfg: RetargetConfig) -> None:
+    def __init__(self, motion_cfg: MotionConfig, retarget_cfg: RetargetConfig, cache_dir: Optional[str] = None, cache_max_mb: float = 1024) -> None:
+        """ If cache_dir is specified, the parsed BVH is loaded from, or saved to, that directory. See BVH.from_file() """
 
         # instantiate the bvh
         try:
-            self.bvh = BVH.from_file(str(motion_cfg.bvh_p), motion_cfg.start_frame_idx, motion_cfg.end_frame_idx)
+            self.bvh = BVH.from_file(str(motion_cfg.bvh_p), motion_cfg.start_frame_idx, motion_cfg.end_frame_idx,
+                                     cache_dir=cache_dir, cache_max_mb=cache_max_mb)
         except Exception as e:
             msg = f'Error loading BVH: {e}'
             logging.critical(msg)
@@ -121,19 +122,15 @@ class Retargeter():
         Rotates them so skeleton faces along the +X axis.
         """
         # get joint positions and forward vectors
-        self.joint_positions = np.empty([self.bvh.frame_max_num, 3 * self.bvh.joint_num], dtype=np.float32)
-        self.fwd_vectors = np.empty([self.bvh.frame_max_num, 3], dtype=np.float32)
-        for frame_idx in range(self.bvh.frame_max_num):
-            self.bvh.apply_frame(frame_idx)
-            self.joint_positions[frame_idx] = self.bvh.root_joint.get_chain_worldspace_positions()
-            self.fwd_vectors[frame_idx] = self.bvh.get_skeleton_fwd(self.forward_perp_vector_joint_names).vs[0]
+        joint_positions = self.bvh.get_all_frames_joint_positions()  # [F, J, 3]
+        self.fwd_vectors = self.bvh.get_all_frames_skeleton_fwd(joint_positions, self.forward_perp_vector_joint_names)
 
         # reposition over origin
-        self.bvh_root_positions = self.joint_positions[:, :3]
-        self.joint_positions = self.joint_positions - np.tile(self.bvh_root_positions, [1, len(self.bvh_joint_names)])
+        self.bvh_root_positions = joint_positions[:, 0]
+        joint_positions = joint_positions - self.bvh_root_positions[:, np.newaxis]
 
         # compute angle between skeleton's forward vector and x axis
-        v1 = np.tile(np.array([1.0, 0.0], dtype=np.float32), reps=(self.joint_positions.shape[0], 1))
+        v1 = np.tile(np.array([1.0, 0.0], dtype=np.float32), reps=(joint_positions.shape[0], 1))
         v2 = self.fwd_vectors
         dot: npt.NDArray[np.float32] = v1[:, 0]*v2[:, 0] + v1[:, 1]*v2[:, 2]
         det: npt.NDArray[np.float32] = v1[:, 0]*v2[:, 2] - v2[:, 0]*v1[:, 1]
@@ -142,15 +139,14 @@ class Retargeter():
         angle = np.where(angle < 0.0, angle + 2*np.pi, angle)
 
         # rotate the skeleton's joint so it faces +X axis
-        for idx in range(self.joint_positions.shape[0]):
-            rot_mat = np.identity(3).astype(np.float32)
-            rot_mat[0, 0] = math.cos(angle[idx])
-            rot_mat[0, 2] = math.sin(angle[idx])
-            rot_mat[2, 0] = -math.sin(angle[idx])
-            rot_mat[2, 2] = math.cos(angle[idx])
+        rot_mats = np.tile(np.identity(3, dtype=np.float32), (joint_positions.shape[0], 1, 1))
+        rot_mats[:, 0, 0] = np.cos(angle)
+        rot_mats[:, 0, 2] = np.sin(angle)
+        rot_mats[:, 2, 0] = -np.sin(angle)
+        rot_mats[:, 2, 2] = np.cos(angle)
+        joint_positions = np.einsum('fij,fkj->fki', rot_mats, joint_positions)
 
-            rotated_joints: npt.NDArray[np.float32] = rot_mat @ self.joint_positions[idx].reshape([-1, 3]).T
-            self.joint_positions[idx] = rotated_joints.T.reshape(self.joint_positions[idx].shape)
+        self.joint_positions = joint_positions.reshape([joint_positions.shape[0], -1])
 
     def _determine_projection_plane_normal(self, group_name: str, joint_names: List[str], projection_method: str) -> npt.NDArray[np.float32]:
         """
@@ -317,14 +313,8 @@ class Retargeter():
         # save it
         self.char_joint_to_orientation[char_joint_name] = np.array(theta)
 
-    def get_retargeted_frame_data(self, time: float) -> Tuple[Dict[str, float], Dict[str, float], npt.NDArray[np.float32]]:
-        """
-        Input: time, in seconds, used to select the correct BVH frame.
-        Calculate the proper frame and, for it, returns:
-            - orientations, dictionary mapping from character joint names to world orientations (degrees CCW from +Y axis)
-            - joint_depths, dictionary mapping from BVH skeleton's joint names to distance from joint to projection plane
-            - root_positions, the position of the character's root at this frame.
-        """
+    def get_frame_idx(self, time: float) -> int:
+        """ Input: time, in seconds. Returns the index of the corresponding BVH frame, clamped to the valid range. """
         frame_idx = int(round(time / self.bvh.frame_time, 0))
 
         if frame_idx < 0:
@@ -335,6 +325,18 @@ class Retargeter():
             logging.info(f'invalid frame_idx ({frame_idx}), replacing with last frame {self.bvh.frame_max_num-1}')
             frame_idx = self.bvh.frame_max_num-1
 
+        return frame_idx
+
+    def get_retargeted_frame_data(self, time: float) -> Tuple[Dict[str, float], Dict[str, float], npt.NDArray[np.float32]]:
+        """
+        Input: time, in seconds, used to select the correct BVH frame.
+        Calculate the proper frame and, for it, returns:
+            - orientations, dictionary mapping from character joint names to world orientations (degrees CCW from +Y axis)
+            - joint_depths, dictionary mapping from BVH skeleton's joint names to distance from joint to projection plane
+            - root_positions, the position of the character's root at this frame.
+        """
+        frame_idx = self.get_frame_idx(time)
+
         orientations = {key: val[frame_idx] for (key, val) in self.char_joint_to_orientation.items()}
 
         joint_depths = {key: val[frame_idx] for (key, val) in self.bvh_joint_to_projection_depth.items()}
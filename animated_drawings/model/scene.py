@@ -2,11 +2,13 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+from typing import List, Optional
 from animated_drawings.model.transform import Transform
 from animated_drawings.model.time_manager import TimeManager
 from animated_drawings.config import SceneConfig
 from animated_drawings.model.floor import Floor
 from animated_drawings.model.animated_drawing import AnimatedDrawing
+from animated_drawings.model.arap import BlockDiagonalARAP
 
 
 class Scene(Transform, TimeManager):
@@ -25,15 +27,28 @@ class Scene(Transform, TimeManager):
             self.add_child(Floor())
 
         # Add the Animated Drawings
+        self.animated_drawings: List[AnimatedDrawing] = []
         for each in cfg.animated_characters:
 
-            ad = AnimatedDrawing(*each)
+            ad = AnimatedDrawing(*each, cache_dir=cfg.cache_dir, cache_max_mb=cfg.cache_max_mb,
+                                 arap_control_mesh_density=cfg.arap_control_mesh_density, mesh_max_vertices=cfg.mesh_max_vertices,
+                                 mask_working_resolution=cfg.mask_working_resolution)
+            ad.arap.set_result_cache(cfg.arap_result_cache_size, cfg.arap_result_cache_quantization)
             self.add_child(ad)
+            self.animated_drawings.append(ad)
 
             # add bvh to the scene if we're going to visualize it
             if cfg.add_ad_retarget_bvh:
                 self.add_child(ad.retargeter.bvh)
 
+        # if specified, deform all characters' meshes with a single combined ARAP solve per time step
+        self.combined_arap: Optional[BlockDiagonalARAP] = None
+        if cfg.combine_arap_solves and self.animated_drawings:
+            self.combined_arap = BlockDiagonalARAP([ad.arap for ad in self.animated_drawings])
+            self.combined_arap.set_result_cache(cfg.arap_result_cache_size, cfg.arap_result_cache_quantization)
+            for ad in self.animated_drawings:
+                ad.defer_arap_solve = True
+
     def progress_time(self, delta_t: float) -> None:
         """
         Entry point called to update time in the scene by delta_t seconds.
@@ -41,6 +56,16 @@ class Scene(Transform, TimeManager):
         we recurvisely go through objects in the scene and call tick() on each TimeManager.
         """
         self._progress_time(self, delta_t)
+        self._solve_deferred_arap()
+
+    def _solve_deferred_arap(self) -> None:
+        """ If any character was updated with its ARAP solve deferred, solves all characters together and scatters the results back. """
+        if self.combined_arap is None or not any(ad.arap_solve_pending for ad in self.animated_drawings):
+            return
+
+        vertices_xy = self.combined_arap.solve_each([ad.control_points for ad in self.animated_drawings])
+        for ad, ad_vertices_xy in zip(self.animated_drawings, vertices_xy):
+            ad.set_deformed_vertices(ad_vertices_xy)
 
     def _progress_time(self, t: Transform, delta_t: float) -> None:
         """ Recursively calls tick() on all TimeManager objects. """
@@ -8,6 +8,10 @@ import numpy.typing as npt
 import cv2
 from pathlib import Path
 import logging
+import os
+import time
+import zipfile
+from typing import Dict, Optional
 from pkg_resources import resource_filename
 
 TOLERANCE = 10**-5
@@ -55,3 +59,77 @@ def read_background_image(file_name: str) -> npt.NDArray[np.uint8]:
         image_np = cv2.cvtColor(image_np, cv2.COLOR_GRAY2RGBA)
 
     return image_np.astype(np.uint8)
+
+
+def read_cache_file(cache_file: Path) -> Optional[Dict[str, npt.NDArray]]:
+    """
+    Loads the arrays stored in an .npz cache file and marks the file as recently used.
+    Returns None if the file doesn't exist or can't be read (e.g. it was truncated), so callers can rebuild and rewrite it.
+    """
+    if not cache_file.exists():
+        return None
+
+    try:
+        with np.load(str(cache_file), allow_pickle=False) as npz:
+            arrays = {key: npz[key] for key in npz.files}
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+        logging.warning(f'Could not read cache file {cache_file}, ignoring it: {e}')
+        return None
+
+    try:
+        os.utime(cache_file)  # bump modification time, used as last-access time during eviction
+    except OSError:  # evicted by another job after loading, but the arrays were already read
+        pass
+
+    return arrays
+
+
+def write_cache_file(cache_file: Path, arrays: Dict[str, npt.NDArray], cache_max_mb: float) -> None:
+    """
+    Saves arrays to an .npz cache file, then evicts least recently used files from its directory until the directory
+    is no larger than cache_max_mb. The file is written under a temporary name and then renamed,
+    so concurrent jobs sharing the directory never read a partially-written file.
+    """
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp_file = cache_file.with_name(f'{cache_file.name}.{os.getpid()}.tmp')
+    try:
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        logging.warning(f'Could not write cache file {cache_file}: {e}')
+        tmp_file.unlink(missing_ok=True)
+        return
+
+    prune_cache_dir(cache_file.parent, cache_max_mb)
+
+
+def prune_cache_dir(cache_dir: Path, cache_max_mb: float, tmp_max_age_s: float = 600.0) -> None:
+    """
+    Deletes least recently used .npz files within cache_dir until their combined size is at most cache_max_mb.
+    Also deletes temporary files not modified for tmp_max_age_s seconds, which were left by jobs that stopped mid-write.
+    """
+    for tmp_file in cache_dir.glob('*.tmp'):
+        try:
+            if time.time() - tmp_file.stat().st_mtime > tmp_max_age_s:
+                tmp_file.unlink(missing_ok=True)
+        except FileNotFoundError:  # renamed or removed by another job
+            continue
+
+    entries = []
+    for cache_file in cache_dir.glob('*.npz'):
+        try:
+            stat = cache_file.stat()
+        except FileNotFoundError:  # removed by another job
+            continue
+        entries.append((stat.st_mtime, stat.st_size, cache_file))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    max_bytes = cache_max_mb * 1024 * 1024
+
+    for _, size, cache_file in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        cache_file.unlink(missing_ok=True)
+        total_bytes -= size
@@ -2,6 +2,9 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import numpy as np
+import pytest
+from scipy.spatial import Delaunay
 from animated_drawings.model.animated_drawing import AnimatedDrawing
 from animated_drawings.config import Config
 from pkg_resources import resource_filename
@@ -25,3 +28,160 @@ def test_init():
     AnimatedDrawing(char_cfg, retarget_cfg, motion_cfg)
 
     assert True
+
+
+def test_mesh_cache(tmp_path, monkeypatch):
+    mvc_cfg_fn = resource_filename(__name__, 'test_animated_drawing_files/test_mvc.yaml')
+
+    def load_animated_drawing():
+        char_cfg, retarget_cfg, motion_cfg = Config(mvc_cfg_fn).scene.animated_characters[0]
+        return AnimatedDrawing(char_cfg, retarget_cfg, motion_cfg, cache_dir=str(tmp_path), arap_control_mesh_density=10)
+
+    ad = load_animated_drawing()
+    assert len(list(tmp_path.glob('mesh_*.npz'))) == 1
+
+    def fail_compute_meshes(self):
+        assert False, 'meshes should have been loaded from cache'
+    monkeypatch.setattr(AnimatedDrawing, '_compute_meshes', fail_compute_meshes)
+
+    cached_ad = load_animated_drawing()
+    assert (cached_ad.mesh['vertices'] == ad.mesh['vertices']).all()
+    assert (np.array(cached_ad.mesh['triangles']) == np.array(ad.mesh['triangles'])).all()
+    assert (cached_ad.arap_mesh['vertices'] == ad.arap_mesh['vertices']).all()
+    assert (cached_ad.arap_to_mesh != ad.arap_to_mesh).nnz == 0
+    assert (cached_ad.vertices[:, [0, 1, 2, 6, 7]] == ad.vertices[:, [0, 1, 2, 6, 7]]).all()  # rgb debug colors are random
+
+
+def test_mesh_max_vertices():
+    mvc_cfg_fn = resource_filename(__name__, 'test_animated_drawing_files/test_mvc.yaml')
+    char_cfg, retarget_cfg, motion_cfg = Config(mvc_cfg_fn).scene.animated_characters[0]
+
+    ad = AnimatedDrawing(char_cfg, retarget_cfg, motion_cfg, mesh_max_vertices=300)
+
+    assert len(ad.mesh['vertices']) <= 300
+    assert len(ad.vertices) == len(ad.mesh['vertices'])
+
+
+def test_mask_working_resolution():
+    mvc_cfg_fn = resource_filename(__name__, 'test_animated_drawing_files/test_mvc.yaml')
+    char_cfg, retarget_cfg, motion_cfg = Config(mvc_cfg_fn).scene.animated_characters[0]
+
+    ad = AnimatedDrawing(char_cfg, retarget_cfg, motion_cfg, mask_working_resolution=char_cfg.img_dim // 2)
+
+    assert ad.mask.shape == (char_cfg.img_dim // 2, char_cfg.img_dim // 2)
+    assert ad.txtr.shape[:2] == AnimatedDrawing(*Config(mvc_cfg_fn).scene.animated_characters[0]).txtr.shape[:2]
+    assert 0.0 <= ad.mesh['vertices'].min() and ad.mesh['vertices'].max() <= 1.0
+    assert set(ad.joint_to_tri_v_idx.keys()) <= {joint['name'] for joint in char_cfg.skeleton}
+
+
+def test_joint_to_triangles_dict():
+    mvc_cfg_fn = resource_filename(__name__, 'test_animated_drawing_files/test_mvc.yaml')
+    char_cfg, retarget_cfg, motion_cfg = Config(mvc_cfg_fn).scene.animated_characters[0]
+
+    ad = AnimatedDrawing(char_cfg, retarget_cfg, motion_cfg)
+
+    # every triangle is assigned to exactly one joint
+    assigned = np.sort(np.concatenate(list(ad.joint_to_tri_v_idx.values())).reshape([-1, 3]), axis=1)
+    triangles = np.sort(np.array(ad.mesh['triangles']), axis=1)
+    assert len(assigned) == len(triangles)
+    assert (np.unique(assigned, axis=0) == np.unique(triangles, axis=0)).all()
+
+    # hand triangles are assigned to the hand's bone
+    hand_xy = np.array(next(joint['loc'] for joint in char_cfg.skeleton if joint['name'] == 'left_hand'))
+    tri_centroids = ad.mesh['vertices'][triangles].mean(axis=1)
+    nearest_tri = triangles[np.argmin(np.linalg.norm(tri_centroids - hand_xy, axis=1))]
+    assert any((np.sort(ad.joint_to_tri_v_idx['left_hand'].reshape([-1, 3]), axis=1) == nearest_tri).all(axis=1))
+
+
+def test_reorder_mesh():
+    vertices = np.random.rand(50, 2).astype(np.float32)
+    triangles = Delaunay(vertices).simplices.astype(np.int32)
+
+    new_vertices, new_triangles = AnimatedDrawing._reorder_mesh(vertices, triangles)
+
+    # map new vertex ids back to the old ones via their positions; the triangles, and their winding, must be unchanged
+    old_v_idx = {tuple(v): idx for idx, v in enumerate(vertices)}
+    new_to_old_v_idx = np.array([old_v_idx[tuple(v)] for v in new_vertices])
+
+    def canonical(tris):  # rotate each triangle to start with its lowest vertex id, keeping its winding
+        return sorted(tuple(np.roll(tri, -np.argmin(tri))) for tri in tris)
+    assert canonical(new_to_old_v_idx[new_triangles]) == canonical(triangles)
+
+
+def test_texture_cropped_to_mask():
+    mvc_cfg_fn = resource_filename(__name__, 'test_animated_drawing_files/test_mvc.yaml')
+    char_cfg, retarget_cfg, motion_cfg = Config(mvc_cfg_fn).scene.animated_characters[0]
+
+    ad = AnimatedDrawing(char_cfg, retarget_cfg, motion_cfg)
+
+    # texture is the drawing, unrotated, cropped to the mask
+    txtr_h, txtr_w, _ = ad.txtr.shape
+    assert txtr_h <= char_cfg.img_height and txtr_w <= char_cfg.img_width
+    assert txtr_h * txtr_w < char_cfg.img_dim ** 2
+
+    # texture coordinates stay within it, and map upright mesh coordinates to the same point of the drawing as before
+    u, v = ad.vertices[:, 6], ad.vertices[:, 7]
+    assert 0.0 <= u.min() and u.max() <= 1.0 and 0.0 <= v.min() and v.max() <= 1.0
+    txtr_top, txtr_left = ad.txtr_origin
+    drawing_row = v * txtr_h + txtr_top
+    drawing_col = u * txtr_w + txtr_left
+    assert np.allclose(drawing_col, ad.mesh['vertices'][:, 0] * char_cfg.img_dim, atol=1e-3)
+    assert np.allclose(char_cfg.img_height - drawing_row, ad.mesh['vertices'][:, 1] * char_cfg.img_dim, atol=1e-3)
+
+
+def test_rig_joint_transforms_match_forward_kinematics():
+    mvc_cfg_fn = resource_filename(__name__, 'test_animated_drawing_files/test_mvc.yaml')
+    char_cfg, retarget_cfg, motion_cfg = Config(mvc_cfg_fn).scene.animated_characters[0]
+
+    ad = AnimatedDrawing(char_cfg, retarget_cfg, motion_cfg)
+    ad.set_time(1.0)
+    ad.update()
+
+    # joint Transforms are only updated when needed to draw the rig
+    ad.rig._update_joint_transforms()
+    transform_positions = np.array(ad.rig.root_joint.get_chain_worldspace_positions()).reshape([-1, 3])[:, :2]
+    assert np.allclose(transform_positions, ad.rig.get_joints_2D_positions(), atol=1e-5)
+
+
+def test_clip_joints_2D_positions_match_per_frame_posing():
+    mvc_cfg_fn = resource_filename(__name__, 'test_animated_drawing_files/test_mvc.yaml')
+    char_cfg, retarget_cfg, motion_cfg = Config(mvc_cfg_fn).scene.animated_characters[0]
+
+    ad = AnimatedDrawing(char_cfg, retarget_cfg, motion_cfg)
+    clip_positions = ad.rig.get_clip_joints_2D_positions(ad.retargeter.char_joint_to_orientation)
+    assert clip_positions.shape == (ad.retargeter.bvh.frame_max_num, ad.rig.joint_count, 2)
+
+    for frame_idx in range(0, ad.retargeter.bvh.frame_max_num, 7):
+        ad.set_time(frame_idx * ad.retargeter.bvh.frame_time)
+        ad.update()
+        assert np.allclose(clip_positions[frame_idx], ad.control_points, atol=1e-5)
+
+
+def test_vertex_track_is_solved_in_windows():
+    mvc_cfg_fn = resource_filename(__name__, 'test_animated_drawing_files/test_mvc.yaml')
+
+    def load_animated_drawing():
+        char_cfg, retarget_cfg, motion_cfg = Config(mvc_cfg_fn).scene.animated_characters[0]
+        return AnimatedDrawing(char_cfg, retarget_cfg, motion_cfg)
+
+    ad = load_animated_drawing()
+    tracked_ad = load_animated_drawing()
+    tracked_ad.precompute_vertex_track(frames_per_pass=16)
+    assert tracked_ad.vertex_track is not None and len(tracked_ad.vertex_track) == 16
+
+    frame_time = ad.retargeter.bvh.frame_time
+    for frame_idx in list(range(0, 40)) + [124, 3]:  # play forward across windows, then jump to the end and back
+        for each in (ad, tracked_ad):
+            each.set_time(frame_idx * frame_time)
+            each.update()
+        assert tracked_ad.vertex_track_start_idx <= frame_idx < tracked_ad.vertex_track_start_idx + 16
+        assert np.allclose(tracked_ad.vertices[:, :3], ad.vertices[:, :3], atol=1e-5)
+
+
+def test_rig_rejects_root_orientation():
+    mvc_cfg_fn = resource_filename(__name__, 'test_animated_drawing_files/test_mvc.yaml')
+    char_cfg, retarget_cfg, motion_cfg = Config(mvc_cfg_fn).scene.animated_characters[0]
+
+    ad = AnimatedDrawing(char_cfg, retarget_cfg, motion_cfg)
+    with pytest.raises(AssertionError):
+        ad.rig.set_global_orientations({ad.rig.root_joint.name: 90.0})
@@ -2,8 +2,10 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import os
+import time
 import numpy as np
-from animated_drawings.model.arap import ARAP, plot_mesh
+from animated_drawings.model.arap import ARAP, BlockDiagonalARAP, get_barycentric_interpolation_matrix, plot_mesh
 
 
 def test_single_triangle_mesh():
@@ -114,3 +116,240 @@ def test_four_triangle_mesh():
         [1.46633111e+00, 2.60720416e+00],
         [2.82413859e+00, 2.62209072e+00]
     ])).all()
+
+
+def test_solve_batch_matches_solve():
+    vertices = np.array([
+        [0.0, 0.0],
+        [0.0, 1.0],
+        [1.0, 1.0],
+        [1.0, 0.0],
+        [2.0, 1.0],
+        [2.0, 0.0],
+    ])
+
+    triangles = np.array([
+        [0, 1, 2],
+        [0, 2, 3],
+        [3, 2, 4],
+        [3, 4, 5],
+    ], np.int32)
+
+    pins_xy = np.array([[0.0, 0.0], [0.0, 1.0], [2.0, 0.0]])
+    arap = ARAP(pins_xy, triangles=triangles, vertices=vertices)
+
+    frames_pins_xy = np.array([
+        [[0.0, 0.0], [0.0, 1.0], [2.0, 0.0]],
+        [[0.0, 0.0], [0.0, 3.0], [6.0, 0.0]],
+        [[1.0, 0.5], [0.5, 2.0], [3.0, -1.0]],
+    ])
+    v_batch = arap.solve_batch(frames_pins_xy, frames_per_pass=2)
+
+    assert v_batch.shape == (3, 6, 2)
+    for frame_idx, frame_pins_xy in enumerate(frames_pins_xy):
+        assert np.isclose(v_batch[frame_idx], arap.solve(frame_pins_xy)).all()
+
+    # results can be written straight into a lower precision buffer
+    out = np.empty([3, 6, 2], dtype=np.float32)
+    assert arap.solve_batch(frames_pins_xy, frames_per_pass=2, out=out) is out
+    assert np.allclose(out, v_batch, atol=1e-5)
+
+
+def test_precomputation_cache(tmp_path):
+    vertices = np.array([
+        [0.0, 0.0],
+        [0.0, 1.0],
+        [1.0, 1.0],
+        [1.0, 0.0],
+        [2.0, 1.0],
+        [2.0, 0.0],
+    ])
+
+    triangles = np.array([
+        [0, 1, 2],
+        [0, 2, 3],
+        [3, 2, 4],
+        [3, 4, 5],
+    ], np.int32)
+
+    pins_xy = np.array([[0.0, 0.0], [0.0, 1.0], [2.0, 0.0]])
+    arap = ARAP(pins_xy, triangles=triangles, vertices=vertices, cache_dir=str(tmp_path))
+    assert len(list(tmp_path.glob('arap_*.npz'))) == 1
+
+    def fail_precompute(*args, **kwargs):
+        assert False, 'precomputation should have been loaded from cache'
+    cached_arap = ARAP.__new__(ARAP)
+    cached_arap._precompute = fail_precompute
+    cached_arap.__init__(pins_xy, triangles=triangles, vertices=vertices, cache_dir=str(tmp_path))
+
+    new_pins_xy = np.array([[1.0, 0.5], [0.5, 2.0], [3.0, -1.0]])
+    assert np.isclose(cached_arap.solve(new_pins_xy), arap.solve(new_pins_xy)).all()
+
+    # different pins produce a different cache file; the older one is evicted once the cache is full
+    old_cache_file, = tmp_path.glob('arap_*.npz')
+    cache_max_mb = 1.5 * old_cache_file.stat().st_size / (1024 * 1024)
+    ARAP(new_pins_xy, triangles=triangles, vertices=vertices, cache_dir=str(tmp_path), cache_max_mb=cache_max_mb)
+    cache_files = list(tmp_path.glob('arap_*.npz'))
+    assert len(cache_files) == 1 and cache_files[0] != old_cache_file
+
+    # temporary files left by jobs that stopped mid-write are removed once stale, but not while possibly still being written
+    stale_tmp_file, fresh_tmp_file = tmp_path / 'arap_stale.npz.1.tmp', tmp_path / 'arap_fresh.npz.2.tmp'
+    stale_tmp_file.write_bytes(b'partial')
+    fresh_tmp_file.write_bytes(b'partial')
+    os.utime(stale_tmp_file, (time.time() - 3600, time.time() - 3600))
+    ARAP(pins_xy, triangles=triangles, vertices=vertices, cache_dir=str(tmp_path), cache_max_mb=cache_max_mb)
+    assert not stale_tmp_file.exists() and fresh_tmp_file.exists()
+
+
+def test_xy_to_barycentric_coords():
+    vertices = np.array([
+        [0.0, 0.0],
+        [0.0, 1.0],
+        [1.0, 1.0],
+        [1.0, 0.0],
+        [2.0, 1.0],
+        [2.0, 0.0],
+    ])
+
+    triangles = np.array([
+        [0, 1, 2],
+        [0, 2, 3],
+        [3, 2, 4],
+        [3, 4, 5],
+    ], np.int64)
+
+    arap = ARAP(np.array([[0.0, 0.0]]), triangles=triangles, vertices=vertices)
+
+    points = np.array([
+        [0.25, 0.5],   # inside triangle 0
+        [1.5, 0.25],   # inside triangle 3
+        [0.5, 0.5],    # on edge shared by triangles 0 and 1
+        [3.0, 0.5],    # outside mesh
+        [1.0, -0.5],   # outside mesh
+    ])
+    v_idxs, bc, pin_mask = arap._xy_to_barycentric_coords(points, vertices, triangles)
+
+    assert (pin_mask == [True, True, True, False, False]).all()
+    assert (v_idxs == triangles[[0, 3, 0]]).all()
+    assert np.isclose(bc.sum(axis=1), 1.0).all()
+    assert np.isclose(np.einsum('ij,ijk->ik', bc, vertices[v_idxs]), points[pin_mask]).all()
+
+
+def test_update_pins_matches_new_arap():
+    vertices = np.array([
+        [0.0, 0.0],
+        [0.0, 1.0],
+        [1.0, 1.0],
+        [1.0, 0.0],
+        [2.0, 1.0],
+        [2.0, 0.0],
+    ])
+
+    triangles = np.array([
+        [0, 1, 2],
+        [0, 2, 3],
+        [3, 2, 4],
+        [3, 4, 5],
+    ], np.int32)
+
+    pins_xy = np.array([[0.0, 0.0], [0.0, 1.0], [2.0, 0.0]])
+    arap = ARAP(pins_xy, triangles=triangles, vertices=vertices)
+
+    for new_pins_xy in [
+        np.array([[0.1, 0.1], [0.0, 1.0], [2.0, 0.0]]),              # re-bind a pin
+        np.array([[0.0, 1.0], [2.0, 0.0]]),                          # remove a pin
+        np.array([[0.0, 0.0], [0.0, 1.0], [2.0, 0.0], [1.5, 0.5]]),  # add a pin
+    ]:
+        arap.update_pins(new_pins_xy)
+        new_arap = ARAP(new_pins_xy, triangles=triangles, vertices=vertices)
+
+        posed_pins_xy = 2.0 * new_pins_xy + 1.0
+        assert np.isclose(arap.solve(posed_pins_xy), new_arap.solve(posed_pins_xy)).all()
+
+
+def test_block_diagonal_arap_matches_separate_solves():
+    vertices = np.array([
+        [0.0, 0.0],
+        [0.0, 1.0],
+        [1.0, 1.0],
+        [1.0, 0.0],
+        [2.0, 1.0],
+        [2.0, 0.0],
+    ])
+
+    triangles = np.array([
+        [0, 1, 2],
+        [0, 2, 3],
+        [3, 2, 4],
+        [3, 4, 5],
+    ], np.int32)
+
+    arap_a = ARAP(np.array([[0.0, 0.0], [0.0, 1.0], [2.0, 0.0]]), triangles=triangles, vertices=vertices)
+    arap_b = ARAP(np.array([[0.2, 0.2], [3.0, 3.0], [0.8, 0.9]]), triangles=triangles[:2], vertices=vertices[:4])  # middle pin outside mesh
+    combined = BlockDiagonalARAP([arap_a, arap_b])
+
+    pins_a = np.array([[1.0, 0.5], [0.5, 2.0], [3.0, -1.0]])
+    pins_b = np.array([[0.2, 0.2], [0.0, 0.0], [1.8, 0.9]])
+    v_a, v_b = combined.solve_each([pins_a, pins_b])
+
+    assert np.isclose(v_a, arap_a.solve(pins_a)).all()
+    assert np.isclose(v_b, arap_b.solve(pins_b)).all()
+
+    # pin bindings refer to the combined vertex array
+    combined_pins_xy = combined.arap.vertices[combined.arap.pins_v_idxs]
+    assert np.allclose(np.einsum('pij,pi->pj', combined_pins_xy, combined.arap.pins_bc), [[0.0, 0.0], [0.0, 1.0], [2.0, 0.0], [0.2, 0.2], [0.8, 0.9]])
+
+
+def test_barycentric_interpolation_matrix():
+    vertices = np.array([
+        [0.0, 0.0],
+        [0.0, 1.0],
+        [1.0, 1.0],
+        [1.0, 0.0],
+    ])
+
+    triangles = np.array([
+        [0, 1, 2],
+        [0, 2, 3],
+    ], np.int32)
+
+    points = np.array([[0.25, 0.5], [0.75, 0.25], [1.0, 1.0], [1.25, 0.5]])  # last point outside mesh
+    B = get_barycentric_interpolation_matrix(points, vertices, triangles)
+
+    assert B.shape == (4, 4)
+    assert np.isclose(B @ vertices, points).all()
+
+    # affine deformations of the mesh are reproduced exactly, including for points outside of it
+    affine = np.array([[0.5, -1.0], [2.0, 0.3]])
+    offset = np.array([3.0, -2.0])
+    assert np.isclose(B @ (vertices @ affine.T + offset), points @ affine.T + offset).all()
+
+
+def test_result_cache():
+    vertices = np.array([
+        [0.0, 0.0],
+        [0.0, 1.0],
+        [1.0, 1.0],
+        [1.0, 0.0],
+    ])
+
+    triangles = np.array([
+        [0, 1, 2],
+        [0, 2, 3],
+    ], np.int32)
+
+    arap = ARAP(np.array([[0.0, 0.0], [1.0, 1.0]]), triangles=triangles, vertices=vertices)
+    arap.set_result_cache(max_entries=1, quantization=1e-3)
+
+    pose_a = np.array([[0.0, 0.0], [1.0, 2.0]])
+    pose_b = np.array([[0.0, 0.0], [2.0, 1.0]])
+
+    v_a = arap.solve(pose_a)
+    assert arap.solve(pose_a + 1e-5) is v_a  # within quantization of pose_a
+    assert (arap.result_cache_hits, arap.result_cache_misses) == (1, 1)
+
+    v_b = arap.solve(pose_b)  # evicts pose_a
+    assert not np.isclose(v_a, v_b).all()
+    assert arap.solve(pose_a) is not v_a
+    assert np.isclose(arap.solve(pose_a), v_a).all()
+    assert (arap.result_cache_hits, arap.result_cache_misses) == (2, 3)
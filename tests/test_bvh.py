@@ -3,6 +3,10 @@
 # LICENSE file in the root directory of this source tree.
 
 from animated_drawings.model.bvh import BVH
+import os
+import shutil
+import numpy as np
+import pytest
 from pkg_resources import resource_filename
 
 
@@ -30,3 +34,72 @@ def test_bvh_from_file():
     assert b.rot_data.shape[1] == b.root_joint.joint_count()
     # and the rotation is a quaternion with dimensionality of 4
     assert b.rot_data.shape[-1] == 4
+
+
+def test_get_all_frames_joint_positions():
+    bvh_fn = resource_filename(__name__, 'test_bvh_files/zombie.bvh')
+    b = BVH.from_file(bvh_fn)
+    b.set_scale(0.5)
+    b.offset(np.array([1.0, 2.0, 3.0]))
+
+    joint_positions = b.get_all_frames_joint_positions()
+    assert joint_positions.shape == (b.frame_max_num, b.joint_num, 3)
+
+    for frame_idx in range(0, b.frame_max_num, 50):
+        b.apply_frame(frame_idx)
+        expected = np.array(b.root_joint.get_chain_worldspace_positions()).reshape([-1, 3])
+        assert np.allclose(joint_positions[frame_idx], expected, atol=1e-4)
+
+
+def test_bvh_from_file_tolerates_whitespace(tmp_path):
+    bvh_fn = resource_filename(__name__, 'test_bvh_files/zombie.bvh')
+    with open(bvh_fn, 'r') as f:
+        text = f.read()
+
+    # tabs and runs of spaces between tokens, blank lines, and no trailing newline
+    messy_fn = tmp_path / 'messy.bvh'
+    messy_fn.write_text(text.replace(' ', ' \t  ').replace('MOTION', '\nMOTION\n').rstrip())
+
+    b = BVH.from_file(bvh_fn)
+    messy_b = BVH.from_file(str(messy_fn))
+    assert messy_b.get_joint_names() == b.get_joint_names()
+    assert messy_b.frame_max_num == b.frame_max_num
+    assert np.array_equal(messy_b.pos_data, b.pos_data)
+    assert np.array_equal(messy_b.rot_data, b.rot_data)
+
+    # frame count must match the motion data
+    bad_fn = tmp_path / 'bad.bvh'
+    bad_fn.write_text(text.replace('Frames: 779', 'Frames: 780'))
+    with pytest.raises(AssertionError):
+        BVH.from_file(str(bad_fn))
+
+
+def test_bvh_cache(tmp_path, monkeypatch):
+    bvh_fn = tmp_path / 'zombie.bvh'
+    shutil.copy(resource_filename(__name__, 'test_bvh_files/zombie.bvh'), bvh_fn)
+    cache_dir = tmp_path / 'cache'
+
+    b = BVH.from_file(str(bvh_fn), 10, 100, cache_dir=str(cache_dir))
+    assert len(list(cache_dir.glob('bvh_*.npz'))) == 1
+
+    parse_file = BVH._parse_file
+
+    def fail_parse_file(bvh_p):
+        assert False, 'bvh should have been loaded from cache'
+    monkeypatch.setattr(BVH, '_parse_file', fail_parse_file)
+
+    # the cache holds all frames, so other frame ranges are served by it too
+    cached_b = BVH.from_file(str(bvh_fn), 10, 100, cache_dir=str(cache_dir))
+    assert cached_b.get_joint_names() == b.get_joint_names()
+    assert cached_b.frame_time == b.frame_time
+    assert cached_b.frame_max_num == b.frame_max_num
+    assert np.array_equal(cached_b.pos_data, b.pos_data)
+    assert np.array_equal(cached_b.rot_data, b.rot_data)
+    assert np.allclose(cached_b.get_all_frames_joint_positions(), b.get_all_frames_joint_positions())
+    assert BVH.from_file(str(bvh_fn), cache_dir=str(cache_dir)).frame_max_num == 779
+
+    # touching the file invalidates its cache entry
+    os.utime(bvh_fn, ns=(0, 0))
+    monkeypatch.setattr(BVH, '_parse_file', parse_file)
+    BVH.from_file(str(bvh_fn), cache_dir=str(cache_dir))
+    assert len(list(cache_dir.glob('bvh_*.npz'))) == 2
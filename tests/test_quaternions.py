@@ -49,6 +49,16 @@ def test_to_rotation_matrix():
         [0.000000e+00,  0.000000e+00,  0.000000e+00,  1.000000e+00]]))
 
 
+def test_to_rotation_matrices():
+    angles = np.array([[np.pi / 2], [np.pi / 3], [-np.pi / 5]])
+    axis = Vectors(np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.6, 0.8]], dtype=np.float32))
+    qs = Quaternions.from_angle_axis(angles, axis)
+    rot_ms = qs.to_rotation_matrices()
+    assert rot_ms.shape == (3, 3, 3)
+    for idx in range(3):
+        assert np.allclose(rot_ms[idx], Quaternions(qs.qs[idx]).to_rotation_matrix()[:3, :3])
+
+
 def test_from_rotation_matrix():
     angles = np.array([[np.pi / 2]])
     axis = np.array([1.0, 1.0, 0.0], dtype=np.float32)